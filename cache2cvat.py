@@ -0,0 +1,78 @@
+import os
+import argparse
+from tqdm import tqdm
+from src.tracker import Tracker, Tracks
+from src.object import Object
+from src.cache import DetectionCache
+from src.linker import Linker
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Track detections cached by detector2cvat.py and save tracks "
+                                                 "in CVAT for video 1.1 format without running the detector.")
+    parser.add_argument("path_to_cache", help="folder with detection caches")
+    parser.add_argument("path_to_save", help="folder to save CVAT annotations")
+    parser.add_argument("--max-disappeared", type=int, default=40,
+                        help="maximum amount of frames allowed to not detect object")
+    parser.add_argument("--max-distance", type=int, default=300,
+                        help="maximum leap for object between frames")
+    parser.add_argument("--link", action="store_true",
+                        help="link track fragments offline over the whole video before saving")
+    parser.add_argument("--max-gap", type=int, default=300,
+                        help="maximum amount of frames between linked fragments")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    path_to_cache = args.path_to_cache
+    path_to_save = args.path_to_save
+    max_disappeared = args.max_disappeared
+
+    caches = []
+
+    for root, dirs, files in os.walk(path_to_cache):
+        for file in files:
+            # Temporary files of an interrupted DetectionCache.save are not caches.
+            if os.path.splitext(file)[1] == ".npz" and not file.endswith(".tmp.npz"):
+                caches.append(f"{root}/{file}")
+
+    for i, cache_path in enumerate(sorted(caches)):
+        cached = DetectionCache.load(cache_path)
+        metadata = cached.metadata
+        name = metadata["video_name"]
+        # Same layout as detector2cvat.py output.
+        output_folder = path_to_save + os.sep + "/".join(os.path.splitext(metadata["video_path"])[0].split("/")[-3:-1])
+        output_path = f"{output_folder}/{name}.xml"
+        print(f"{i + 1}/{len(caches)}: {cache_path} -> {output_path}")
+
+        if not os.path.exists(output_folder):
+            os.makedirs(output_folder)
+
+        tracker = Tracker(max_disappeared=max_disappeared, max_distance=args.max_distance)
+        # Short fragments are kept for linking and removed after it.
+        tracks = Tracks(max_disappeared=max_disappeared, interpolation="deferred",
+                        video_name=name, video_size=metadata["video_size"],
+                        video_width=metadata["video_width"], video_height=metadata["video_height"],
+                        min_length=0 if args.link else None)
+
+        for index in tqdm(range(len(cached))):
+            detections = cached[index]
+            objects, colors, assignment = tracker.update(detections.centroids(), return_assignment=True)
+            objects = Object.from_assignment(objects, colors, assignment, detections.to_list())
+            tracks.update(objects, index)
+
+        if args.link:
+            tracks.interpolate()
+            fragments = [track for track in tracks.values() if len(track) > 0]
+            linked = Linker(max_gap=args.max_gap, max_distance=args.max_distance).link(fragments)
+            print(f"Linked {len(fragments)} fragments into {len(linked)} tracks")
+            tracks.reset()
+
+            for track in linked:
+                if len(track) > max_disappeared * 2:
+                    tracks.refined.add(track.object_id)
+                    tracks[track.object_id] = track
+
+        tracks.save(output_path, "cvat")
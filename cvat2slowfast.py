@@ -1,11 +1,11 @@
 import os
 import sys
 import json
-from lxml import etree
-from collections import OrderedDict
 import pandas as pd
 from natsort import natsorted
 import cv2
+from src.cvat import Annotation
+from src.frames import FrameReader
 
 if __name__ == "__main__":
     if len(sys.argv) != 3:
@@ -80,30 +80,14 @@ if __name__ == "__main__":
                         print(f"{video_file} does not exist.")
                         continue
 
-                    root = etree.parse(annotation_file).getroot()
+                    annotation = Annotation.load(annotation_file)
 
-                    try:
-                        label = next(root.iterfind("track")).attrib["label"]
-                    except StopIteration:
+                    if len(annotation.track_ids) == 0:
                         print(f"SKIPPED: {folder}/actions/{file}, EMPTY ANNOTATION")
                         continue
 
-                    annotated = OrderedDict()
-
-                    for track in root.iterfind("track"):
-                        for entry in track.iter("points"):
-                            frame_id = entry.attrib["frame"]
-                            outside = entry.attrib["outside"]
-
-                            if outside == "1":
-                                continue
-
-                            behavior = "".join(entry.find("attribute").itertext())
-
-                            if annotated.get(frame_id) is None:
-                                annotated[frame_id] = OrderedDict()
-
-                            annotated[frame_id] = behavior
+                    label = annotation.labels[annotation.track_labels[0]]
+                    annotated = annotation.behaviors_by_frame()
 
                     counter = 0
 
@@ -124,46 +108,30 @@ if __name__ == "__main__":
                     print(progress)
                     sys.stdout.flush()
 
-                    index = 0
                     adjusted_index = 1
                     vc = cv2.VideoCapture(video_file)
                     size = int(vc.get(cv2.CAP_PROP_FRAME_COUNT))
+                    # Frames without a known behavior are never decoded.
+                    frames = [index for index in range(size) if old2new[annotated.get(str(index))] in label2number]
+
+                    if not os.path.exists(output_folder):
+                        os.makedirs(output_folder)
+
+                    for index, frame in (FrameReader(vc, frames) if flag else ((index, None) for index in frames)):
+                        behavior = old2new[annotated.get(str(index))]
+
+                        if flag:
+                            cv2.imwrite(f"{output_folder}/{adjusted_index}.jpg", frame)
+
+                        # TODO: Major slow down here. Add to a list rather than dataframe,
+                        #  and create dataframe at the end.
+                        charades_df.loc[len(charades_df.index)] = [f"{folder_code}",
+                                                                   video_id,
+                                                                   adjusted_index,
+                                                                   f"{folder_code}/{adjusted_index}.jpg",
+                                                                   str(label2number[behavior])]
 
-                    while vc.isOpened():
-                        if flag is False:
-                            if index < size:
-                                returned = True
-                                frame = None
-                            else:
-                                returned = False
-                                frame = None
-                        else:
-                            returned, frame = vc.read()
-
-                        if returned:
-                            if not os.path.exists(output_folder):
-                                os.makedirs(output_folder)
-
-                            behavior = annotated.get(str(index))
-                            behavior = old2new[behavior]
-
-                            if behavior in label2number.keys():
-                                if flag:
-                                    cv2.imwrite(f"{output_folder}/{adjusted_index}.jpg", frame)
-
-                                # TODO: Major slow down here. Add to a list rather than dataframe,
-                                #  and create dataframe at the end.
-                                charades_df.loc[len(charades_df.index)] = [f"{folder_code}",
-                                                                           video_id,
-                                                                           adjusted_index,
-                                                                           f"{folder_code}/{adjusted_index}.jpg",
-                                                                           str(label2number[behavior])]
-
-                                adjusted_index += 1
-
-                            index += 1
-                        else:
-                            break
+                        adjusted_index += 1
 
                     vc.release()
                     video_id += 1
@@ -1,12 +1,24 @@
 import os
 import sys
 import cv2
+import numpy as np
 import ruamel.yaml as yaml
-from lxml import etree
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from tqdm import tqdm
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from natsort import natsorted
+from src.cvat import Annotation
+from src.frames import FrameReader
+
+
+def save(image_path, frame, label_path, lines):
+    cv2.imwrite(image_path, frame)
+
+    # All boxes of the frame in one write.
+    with open(label_path, "a") as file:
+        file.write("".join(lines))
+
 
 if __name__ == "__main__":
     if len(sys.argv) != 4 and len(sys.argv) != 5:
@@ -60,6 +72,11 @@ if __name__ == "__main__":
         "Giraffe": 2
     }
 
+    # JPEG encoding runs in the background, at most max_pending frames wait in memory.
+    executor = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
+    pending = deque()
+    max_pending = 32
+
     print("Process CVAT annotations...")
     videos = []
     annotations = []
@@ -83,84 +100,64 @@ if __name__ == "__main__":
             continue
 
         # Parse CVAT for video 1.1 annotation file.
-        root = etree.parse(annotation).getroot()
+        cvat = Annotation.load(annotation)
         name = os.path.splitext(video.split("/")[-1])[0]
-
-        if root.find("meta").find("task") is not None:
-            annotated_size = int("".join(root.find("meta").find("task").find("size").itertext()))
-            width = int("".join(root.find("meta").find("task").find("original_size").find("width").itertext()))
-            height = int("".join(root.find("meta").find("task").find("original_size").find("height").itertext()))
-        else:
-            annotated_size = int("".join(root.find("meta").find("job").find("size").itertext()))
-            width = int("".join(root.find("meta").find("original_size").find("width").itertext()))
-            height = int("".join(root.find("meta").find("original_size").find("height").itertext()))
+        annotated_size = cvat.size
+        width = cvat.width
+        height = cvat.height
 
         annotated = dict()
         track2end = {}
 
-        for track in root.iterfind("track"):
-            track_id = int(track.attrib["id"])
-            label = label2index[track.attrib["label"].lower().capitalize()]
-
-            for box in track.iter("box"):
-                frame_id = int(box.attrib["frame"])
-                keyframe = int(box.attrib["keyframe"])
+        # Tracks end at their last keyframe.
+        for frame_id, track_id in zip(cvat.frame[cvat.keyframe].tolist(),
+                                      cvat.track_id[cvat.keyframe].tolist()):
+            track2end[track_id] = frame_id
 
-                if keyframe == 1:
-                    track2end[track_id] = frame_id
+        x_start, y_start, x_end, y_end = cvat.xtl, cvat.ytl, cvat.xbr, cvat.ybr
+        x_center = (x_start + (x_end - x_start) / 2) / width
+        y_center = (y_start + (y_end - y_start) / 2) / height
+        w = (x_end - x_start) / width
+        h = (y_end - y_start) / height
+        labels = [label2index[label.lower().capitalize()] for label in cvat.labels]
 
-        for track in root.iterfind("track"):
-            track_id = int(track.attrib["id"])
-            label = label2index[track.attrib["label"].lower().capitalize()]
+        for frame_id, track_id, label, box in zip(cvat.frame.tolist(), cvat.track_id.tolist(),
+                                                  cvat.label.tolist(),
+                                                  np.stack([x_center, y_center, w, h], axis=1).tolist()):
+            if annotated.get(frame_id) is None:
+                annotated[frame_id] = OrderedDict()
 
-            for box in track.iter("box"):
-                frame_id = int(box.attrib["frame"])
+            if frame_id <= track2end[track_id]:
+                annotated[frame_id][track_id] = [labels[label]] + box
 
-                if annotated.get(frame_id) is None:
-                    annotated[frame_id] = OrderedDict()
-
-                if frame_id <= track2end[track_id]:
-                    x_start = float(box.attrib["xtl"])
-                    y_start = float(box.attrib["ytl"])
-                    x_end = float(box.attrib["xbr"])
-                    y_end = float(box.attrib["ybr"])
-                    x_center = (x_start + (x_end - x_start) / 2) / width
-                    y_center = (y_start + (y_end - y_start) / 2) / height
-                    w = (x_end - x_start) / width
-                    h = (y_end - y_start) / height
-                    annotated[frame_id][track_id] = [label, x_center, y_center, w, h]
-
-        index = 0
         vc = cv2.VideoCapture(video)
         pbar = tqdm(total=annotated_size)
+        decoded = 0
+        # Only every skip-th frame with boxes of a running track is decoded.
+        frames = [index for index in FrameReader.annotated(cvat, skip).tolist() if len(annotated[index]) > 0]
 
-        while vc.isOpened():
-            returned, frame = vc.read()
-            saved = False
+        # Skipped frames are only grabbed, sampled ones are retrieved.
+        for index, frame in FrameReader(vc, frames):
+            lines = [f"{box[0]} {box[1]:.6f} {box[2]:.6f} {box[3]:.6f} {box[4]:.6f}\n"
+                     for box in annotated[index].values()]
 
-            if returned:
-                if index > max(track2end.values()):
-                    pbar.update(annotated_size - index)
-                    break
+            while len(pending) >= max_pending:
+                pending.popleft().result()
 
-                if annotated.get(index) is not None:
-                    if index % skip == 0:
-                        for box in annotated[index].values():
-                            if not saved:
-                                cv2.imwrite(f"{dataset}/images/train/{name}_{index}.jpg", frame)
-                                saved = True
-
-                            with open(f"{dataset}/labels/train/{name}_{index}.txt", "a") as file:
-                                file.write(f"{box[0]} {box[1]:.6f} {box[2]:.6f} {box[3]:.6f} {box[4]:.6f}\n")
-
-                index += 1
-                pbar.update(1)
-            else:
-                break
+            pending.append(executor.submit(save, f"{dataset}/images/train/{name}_{index}.jpg", frame,
+                                           f"{dataset}/labels/train/{name}_{index}.txt", lines))
+            pbar.update(index + 1 - decoded)
+            decoded = index + 1
 
+        pbar.update(max(0, annotated_size - decoded))
         pbar.close()
         vc.release()
 
+    while len(pending) > 0:
+        pending.popleft().result()
+
+    executor.shutdown()
+
     print("Distribute train, val, and test...")
     images = natsorted([file for file in os.listdir(f"{dataset}/images/train") if
                         os.path.isfile(os.path.join(f"{dataset}/images/train", file))])
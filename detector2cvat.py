@@ -1,19 +1,144 @@
 import os
-import sys
+import argparse
+import threading
 import cv2
 from tqdm import tqdm
 from src.yolo import YOLOv8
 from src.tracker import Tracker, Tracks
 from src.object import Object
 from src.draw import Draw
+from src.pipeline import Channel, Stage
+from src.cache import DetectionCache
+from src.detections import Detections
+from src.stride import Stride
+from src.motion import MotionGate
+from src.regions import Regions
 
-if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("python detector2cvat path_to_videos path_to_save")
-        exit(0)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Detect objects with YOLOv8, track them and save tracks "
+                                                 "in CVAT for video 1.1 format.")
+    parser.add_argument("path_to_videos", help="folder with .mp4 videos")
+    parser.add_argument("path_to_save", help="folder to save CVAT annotations and demo videos")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="number of frames passed to the detector in one call")
+    parser.add_argument("--tile-size", type=int, default=None,
+                        help="detect on overlapping tiles of this size (e.g. 640 or 1280) instead of the whole frame")
+    parser.add_argument("--tile-overlap", type=float, default=0.2,
+                        help="fraction of a tile shared with its neighbours")
+    parser.add_argument("--headless", action="store_true",
+                        help="do not show the preview window")
+    parser.add_argument("--demo-scale", type=float, default=1.0,
+                        help="resolution scale of the _demo.mp4 video, 0 disables it")
+    parser.add_argument("--cache", default=None,
+                        help="folder with detection caches, detections are reused from it or saved to it")
+    parser.add_argument("--max-disappeared", type=int, default=40,
+                        help="maximum amount of frames allowed to not detect object")
+    parser.add_argument("--max-distance", type=int, default=300,
+                        help="maximum leap for object between frames")
+    parser.add_argument("--stride", type=int, default=1,
+                        help="run the detector on every k-th frame, frames in between are tracker predictions "
+                             "with interpolated boxes")
+    parser.add_argument("--max-shift", type=int, default=0,
+                        help="detect more often than --stride while animals move more than this many pixels "
+                             "between detections, 0 keeps the stride fixed")
+    parser.add_argument("--motion-gate", type=float, default=0,
+                        help="skip detection while no 16x16 block of the downsampled frame changes more than this "
+                             "mean absolute difference (0-255) from the last detected frame after camera motion, "
+                             "skipped frames are tracker predictions with interpolated boxes, 0 disables it")
+    parser.add_argument("--roi-size", type=int, default=0,
+                        help="between full scans only detect windows of this size (e.g. 640) around known animals, "
+                             "0 always detects the whole frame")
+    parser.add_argument("--full-scan", type=int, default=30,
+                        help="detect the whole frame on every n-th detected frame with --roi-size")
+    parser.add_argument("--roi-padding", type=int, default=64,
+                        help="pixels added around known animals with --roi-size")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip finished videos and continue interrupted ones from their last checkpoint")
+    parser.add_argument("--checkpoint-interval", type=int, default=1000,
+                        help="save live tracks and tracker state every n frames for --resume")
+    args = parser.parse_args()
+
+    if args.stride > args.max_disappeared:
+        # The tracker would delete every object between two detections.
+        parser.error("--stride must not be larger than --max-disappeared")
+
+    return args
+
+
+def read_batches(vc, batch_size, start=0):
+    frames = []
+
+    while vc.isOpened():
+        returned, frame = vc.read()
+
+        if not returned:
+            break
+
+        frames.append(frame)
+
+        if len(frames) == batch_size:
+            yield start, frames
+            start += len(frames)
+            frames = []
+
+    if len(frames) > 0:
+        yield start, frames
+
+
+def skip_batches(size, batch_size, first=0):
+    # Cached detections without visualization do not need decoded frames.
+    for start in range(first, size, batch_size):
+        yield start, [None] * min(batch_size, size - start)
+
+
+def detect_batch(batch, yolo, cached, stride, gate=None, regions=None):
+    """Detections of the frames chosen by stride, None for the other frames.
+    Frames the motion gate finds unchanged are not detected either,
+    with regions only windows around known animals are detected between full scans."""
+
+    start, frames = batch
+    indices = stride.plan(start, len(frames))
+    batch_detections = [None] * len(frames)
+    detect = [j for j in indices if gate is None or frames[j - start] is None or not gate.skip(frames[j - start])]
+
+    if cached is None and regions is not None:
+        plans = [regions.plan(frames[j - start].shape[1], frames[j - start].shape[0]) for j in detect]
+        full = [j for j, plan in zip(detect, plans) if plan is None]
+        cropped = [(j, plan) for j, plan in zip(detect, plans) if plan is not None]
+        detected = dict(zip(full, yolo.detect_batch([frames[j - start] for j in full])))
+        detected.update(zip([j for j, _ in cropped],
+                            yolo.detect_regions([frames[j - start] for j, _ in cropped],
+                                                [plan for _, plan in cropped], regions.size)))
+        detected = [detected[j] for j in detect]
+
+        for detections in detected:
+            regions.update(detections)
+    elif cached is None:
+        detected = yolo.detect_batch([frames[j - start] for j in detect]) if len(detect) > 0 else []
     else:
-        path_to_videos = sys.argv[1]
-        path_to_save = sys.argv[2]
+        empty = Detections.concatenate([], cached.labels)
+        detected = [cached[j] if j < len(cached) else empty for j in detect]
+
+    detected = dict(zip(detect, detected))
+
+    for j in detect:
+        batch_detections[j - start] = detected[j]
+        stride.update(j, detected[j].centroids())
+
+    return start, frames, batch_detections
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    path_to_videos = args.path_to_videos
+    path_to_save = args.path_to_save
+    batch_size = max(1, args.batch_size)
+    headless = args.headless
+    demo_scale = args.demo_scale
+    path_to_cache = args.cache
+    # Frames are only drawn on when somebody is going to look at them.
+    visualize = not headless or demo_scale > 0
 
     videos = []
 
@@ -27,7 +152,16 @@ if __name__ == "__main__":
 
                 videos.append(f"{root}/{file}")
 
-    yolo = YOLOv8(weights="yolov8x.pt", imgsz=3840, conf=0.5)
+    weights = "yolov8x.pt"
+    conf = 0.5
+
+    if args.tile_size is None:
+        imgsz = 3840
+        yolo = YOLOv8(weights=weights, imgsz=imgsz, conf=conf)
+    else:
+        imgsz = args.tile_size
+        yolo = YOLOv8(weights=weights, imgsz=imgsz, conf=conf,
+                      tile_size=args.tile_size, tile_overlap=args.tile_overlap)
 
     for i, video in enumerate(videos):
         try:
@@ -35,8 +169,14 @@ if __name__ == "__main__":
 
             output_folder = path_to_save + os.sep + "/".join(os.path.splitext(video)[0].split("/")[-3:-1])
             output_path = f"{output_folder}/{name}.xml"
+            # Finalized tracks are streamed here while the video is processed.
+            sidecar_path = f"{output_folder}/{name}.tracks.jsonl"
             print(f"{i + 1}/{len(videos)}: {video} -> {output_path}")
 
+            if args.resume and os.path.exists(output_path) and not os.path.exists(sidecar_path):
+                print("Already done")
+                continue
+
             if not os.path.exists(output_folder):
                 os.makedirs(output_folder)
 
@@ -44,59 +184,183 @@ if __name__ == "__main__":
             size = int(vc.get(cv2.CAP_PROP_FRAME_COUNT))
             width = int(vc.get(cv2.CAP_PROP_FRAME_WIDTH))
             height = int(vc.get(cv2.CAP_PROP_FRAME_HEIGHT))
-            vw = cv2.VideoWriter(f"{output_folder}/{name}_demo.mp4", cv2.VideoWriter_fourcc("m", "p", "4", "v"),
-                                 29.97, (width, height))
-            max_disappeared = 40
-            tracker = Tracker(max_disappeared=max_disappeared, max_distance=300)
-            tracks = Tracks(max_disappeared=max_disappeared, interpolation=True,
+            cached = None
+            recording = None
+
+            if path_to_cache is not None:
+                key = DetectionCache.get_key(video, weights, imgsz, conf, args.tile_size, args.tile_overlap)
+                cache_path = DetectionCache.get_filename(path_to_cache, name, key)
+
+                if os.path.exists(cache_path):
+                    print(f"Use cached detections {cache_path}")
+                    cached = DetectionCache.load(cache_path)
+                else:
+                    recording = DetectionCache(yolo.labels, {"key": key, "video_path": video,
+                                                             "video_name": name, "video_size": size,
+                                                             "video_width": width, "video_height": height,
+                                                             "weights": weights, "imgsz": imgsz, "conf": conf,
+                                                             # 0 without tiles.
+                                                             "tile_size": args.tile_size or 0,
+                                                             "tile_overlap": args.tile_overlap})
+
+            demo_size = (int(width * demo_scale), int(height * demo_scale))
+
+            if demo_scale > 0:
+                vw = cv2.VideoWriter(f"{output_folder}/{name}_demo.mp4", cv2.VideoWriter_fourcc("m", "p", "4", "v"),
+                                     29.97, demo_size)
+            else:
+                vw = None
+
+            max_disappeared = args.max_disappeared
+            tracker = Tracker(max_disappeared=max_disappeared, max_distance=args.max_distance)
+            tracks = Tracks(max_disappeared=max_disappeared, interpolation="deferred",
                             video_name=name, video_size=size, video_width=width, video_height=height)
-            index = 0
+            checkpoint, state = tracks.stream(sidecar_path, resume=args.resume)
+            index = checkpoint + 1
+
+            if state is not None:
+                print(f"Resume from frame {index}")
+                tracker.set_state(state["tracker"])
+
+            if index > 0 or args.stride > 1 or args.motion_gate > 0 or args.roi_size > 0:
+                # Detections of skipped or reused frames are missing, the cache would be incomplete.
+                recording = None
+
+            stride = Stride(args.stride, args.max_shift, args.max_distance)
+            stride.next = index
+            # Cached detections are cheaper than the gate. Tracks survive a missed detection after the longest
+            # run of gated frames: 2 * (max_skipped + 1) * stride is at most max_disappeared.
+            max_skipped = min(30, max(0, max_disappeared // (2 * max(1, args.stride)) - 1))
+            gate = MotionGate(args.motion_gate, max_skipped=max_skipped) \
+                if args.motion_gate > 0 and cached is None else None
+            regions = Regions(args.full_scan, args.roi_size, args.roi_padding) if args.roi_size > 0 else None
+            detected = 0
+
             vc.set(cv2.CAP_PROP_POS_FRAMES, index)
-            pbar = tqdm(total=size)
-
-            while vc.isOpened():
-                returned, frame = vc.read()
-
-                if returned:
-                    visualization = frame.copy()
-                    predictions = yolo.forward(frame)
-                    centroids = []
-                    attributes = []
-
-                    for prediction in predictions:
-                        attribute = {}
-                        centroids.append(YOLOv8.get_centroid(prediction[0]))
-                        attribute["box"] = prediction[0]
-                        attribute["confidence"] = prediction[1]
-                        attribute["label"] = prediction[2]
-                        attributes.append(attribute)
-
-                    objects, colors = tracker.update(centroids)
-                    objects = Object.object_factory(objects, centroids, colors, attributes=attributes)
-                    tracks.update(objects, index)
-
-                    for object in objects:
-                        Draw.track(visualization, tracks[object.object_id].centroids, object.color, 20)
-                        Draw.bounding_box(visualization, object)
-                        Draw.object_id(visualization, object)
-
-                    cv2.putText(visualization, f"Frame: {index}", (50, 50), cv2.FONT_HERSHEY_SIMPLEX,
-                                0.8, (255, 255, 255), 3, cv2.LINE_AA)
-                    cv2.imshow("detector2cvat", cv2.resize(visualization, (int(width // 2.5), int(height // 2.5))))
-                    vw.write(visualization)
-                    key = cv2.waitKey(1)
-                    index += 1
-                    pbar.update(1)
-
-                    if key == 27:
-                        break
+            pbar = tqdm(total=size, initial=index)
+
+            if cached is not None and not visualize:
+                batches = skip_batches(len(cached), batch_size, index)
+            else:
+                batches = read_batches(vc, batch_size, index)
+
+            # Decoding, detection and encoding run in background threads connected by bounded queues,
+            # tracking and drawing stay in the main thread together with the window.
+            stop = threading.Event()
+            decoder = Stage(lambda batch: batch, batches, stop=stop)
+            detector = Stage(lambda batch: detect_batch(batch, yolo, cached, stride, gate, regions), decoder, stop=stop)
+            stages = [decoder, detector]
+
+            if vw is not None:
+                # The encoder drains its queue after the pipeline stops, an error of it stops only the queue.
+                encoded = Channel(maxsize=8)
+
+                if demo_scale == 1:
+                    encoder = Stage(vw.write, encoded, stop=encoded.stop, sink=True)
                 else:
-                    break
+                    encoder = Stage(lambda image: vw.write(cv2.resize(image, demo_size, interpolation=cv2.INTER_AREA)),
+                                    encoded, stop=encoded.stop, sink=True)
+
+                stages.append(encoder)
+
+            for stage in stages:
+                stage.start()
+
+            try:
+                for start, frames, batch_detections in detector:
+                    for frame, detections in zip(frames, batch_detections):
+                        if detections is None:
+                            # Not detected, the tracker predicts objects and their boxes are interpolated.
+                            predictions = []
+                            centroids = []
+                        else:
+                            if recording is not None:
+                                recording.append(detections)
+
+                            predictions = detections.to_list()
+                            centroids = detections.centroids()
+                            detected += 1
+
+                        # Detection is done with this frame, draw on it directly.
+                        visualization = frame
+                        objects, colors, assignment = tracker.update(centroids, return_assignment=True)
+                        objects = Object.from_assignment(objects, colors, assignment, predictions)
+                        tracks.update(objects, index)
+                        key = -1
+
+                        if (index + 1) % args.checkpoint_interval == 0:
+                            tracks.checkpoint(index, {"tracker": tracker.get_state()})
+
+                        if visualize:
+                            for object in objects:
+                                Draw.track(visualization, tracks[object.object_id].centroids, object.color, 20)
+                                Draw.bounding_box(visualization, object)
+                                Draw.object_id(visualization, object)
+
+                            cv2.putText(visualization, f"Frame: {index}", (50, 50), cv2.FONT_HERSHEY_SIMPLEX,
+                                        0.8, (255, 255, 255), 3, cv2.LINE_AA)
+
+                        if not headless:
+                            cv2.imshow("detector2cvat",
+                                       cv2.resize(visualization, (int(width // 2.5), int(height // 2.5))))
+                            key = cv2.waitKey(1)
+
+                        if vw is not None and not encoded.put(visualization):
+                            # Refused only after the encoder failed.
+                            encoder.check()
+
+                        index += 1
+                        pbar.update(1)
+
+                        if key == 27:
+                            stop.set()
+                            break
+
+                    if stop.is_set():
+                        break
+            finally:
+                stopped = stop.is_set()
+                stop.set()
+
+                if vw is not None:
+                    encoded.close()
+
+                for stage in stages:
+                    stage.join()
+
+            for stage in stages:
+                stage.check()
+
+            if stopped and index > checkpoint + 1:
+                # Frames up to index - 1 are tracked, a resumed run continues after them.
+                tracks.checkpoint(index - 1, {"tracker": tracker.get_state()})
+
+            # Only complete videos are cached.
+            if recording is not None and not stopped:
+                recording.save(cache_path)
 
             pbar.close()
             vc.release()
-            vw.release()
-            cv2.destroyAllWindows()
+
+            if args.stride > 1:
+                print(f"Detected {detected}/{index - checkpoint - 1} frames")
+
+            if regions is not None:
+                print(f"Full scans on {regions.full} frames, "
+                      f"{regions.crops} regions on {regions.count - regions.full} frames")
+
+            if gate is not None:
+                print(f"Motion gate skipped detection on {gate.skipped}/{gate.total} frames "
+                      f"({100 * gate.skipped / max(1, gate.total):.1f}%)")
+
+            if vw is not None:
+                vw.release()
+
+            if not headless:
+                cv2.destroyAllWindows()
+
             tracks.save(output_path, "cvat")
+            # Streamed tracks of a stopped video are kept, so it can be resumed.
+            tracks.close(remove=not stopped)
         except:
             print("Something went wrong...")
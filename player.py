@@ -1,9 +1,9 @@
 import os
 import sys
 import json
-from lxml import etree
 from collections import OrderedDict
 import cv2
+from src.cvat import Annotation
 
 
 def on_slider_change(value):
@@ -163,25 +163,10 @@ if __name__ == "__main__":
     if os.path.exists(actions_path):
         for file in os.listdir(actions_path):
             if os.path.splitext(file)[-1] == ".xml":
-                root = etree.parse(f"{actions_path}/{file}").getroot()
-                annotated = OrderedDict()
+                annotation = Annotation.load(f"{actions_path}/{file}")
 
-                for track in root.iterfind("track"):
-                    for entry in track.iter("points"):
-                        frame_id = entry.attrib["frame"]
-                        outside = entry.attrib["outside"]
-
-                        if outside == "1":
-                            continue
-
-                        behavior = "".join(entry.find("attribute").itertext())
-
-                        if annotated.get(frame_id) is None:
-                            annotated[frame_id] = OrderedDict()
-
-                        annotated[frame_id] = behavior
-
-                    actions[os.path.splitext(file)[0]] = annotated
+                if len(annotation.track_ids) > 0:
+                    actions[os.path.splitext(file)[0]] = annotation.behaviors_by_frame()
 
     index = 0
     cv2.namedWindow("TrackPlayer")
@@ -0,0 +1,82 @@
+import os
+import hashlib
+import numpy as np
+from src.detections import Detections
+
+
+class DetectionCache:
+    """Raw detections of every frame of a video stored in one .npz file.
+    Detections of all frames are concatenated, offsets[i]:offsets[i + 1] selects frame i."""
+
+    def __init__(self, labels, metadata=None):
+        self.labels = list(labels)
+        self.metadata = {} if metadata is None else dict(metadata)
+        self.boxes = []
+        self.scores = []
+        self.class_ids = []
+        self.offsets = [0]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        start, end = self.offsets[index], self.offsets[index + 1]
+
+        return Detections(self.boxes[start:end], self.scores[start:end], self.class_ids[start:end], self.labels)
+
+    def append(self, detections):
+        """Add detections of the next frame to a cache that is being recorded."""
+
+        self.boxes.append(detections.boxes)
+        self.scores.append(detections.scores)
+        self.class_ids.append(detections.class_ids)
+        self.offsets.append(self.offsets[-1] + len(detections))
+
+    def save(self, filename):
+        folder = os.path.dirname(filename)
+
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        metadata = {f"meta_{key}": np.array(value) for key, value in self.metadata.items()}
+        # Write to a temporary file first, so an interrupted run never leaves a broken cache.
+        temporary = f"{filename}.tmp.npz"
+        np.savez(temporary, offsets=np.array(self.offsets, dtype=np.int64),
+                 boxes=np.concatenate(self.boxes) if len(self.boxes) > 0 else np.zeros((0, 4), dtype=np.int32),
+                 scores=np.concatenate(self.scores) if len(self.scores) > 0 else np.zeros(0, dtype=np.float32),
+                 class_ids=np.concatenate(self.class_ids) if len(self.class_ids) > 0 else np.zeros(0, dtype=np.int32),
+                 labels=np.array(self.labels), **metadata)
+        os.replace(temporary, filename)
+
+    @staticmethod
+    def load(filename):
+        with np.load(filename) as data:
+            metadata = {key[len("meta_"):]: data[key].item() for key in data.files if key.startswith("meta_")}
+            cache = DetectionCache(data["labels"].tolist(), metadata)
+            cache.offsets = data["offsets"]
+            cache.boxes = data["boxes"]
+            cache.scores = data["scores"]
+            cache.class_ids = data["class_ids"]
+
+        return cache
+
+    @staticmethod
+    def get_filename(folder, name, key):
+        return f"{folder}/{name}_{key[:16]}.npz"
+
+    @staticmethod
+    def get_key(video_path, weights, imgsz, conf, tile_size=None, tile_overlap=None):
+        """Cache key from the video content and the detector settings, tile_overlap only counts with tiles."""
+
+        sha1 = hashlib.sha1()
+
+        with open(video_path, "rb") as file:
+            for chunk in iter(lambda: file.read(16 * 1024 * 1024), b""):
+                sha1.update(chunk)
+
+        sha1.update(f"|{os.path.basename(weights)}|{imgsz}|{conf}|{tile_size}".encode())
+
+        if tile_size is not None:
+            sha1.update(f"|{tile_overlap}".encode())
+
+        return sha1.hexdigest()
@@ -0,0 +1,270 @@
+import os
+import hashlib
+import numpy as np
+from lxml import etree
+from src.utils import load_npz
+
+
+class Annotation:
+    """CVAT for video 1.1 annotation stored as columns, one row per box in document order.
+    Boxes of track i are rows offsets[i]:offsets[i + 1], points (behaviors) of track i are
+    rows point_offsets[i]:point_offsets[i + 1]. label and behavior columns index labels and behaviors,
+    behavior is -1 for points without an attribute."""
+
+    # Bump when the cached arrays change.
+    version = 1
+    cache_folder = os.path.join(os.path.expanduser("~"), ".cache", "kabr-tools", "cvat")
+    columns = ("track_ids", "track_labels", "offsets", "frame", "track_id", "xtl", "ytl", "xbr", "ybr",
+               "keyframe", "outside", "label", "point_offsets", "point_frame", "point_track_id", "point_outside",
+               "point_label", "behavior")
+
+    def __init__(self):
+        self.size = None
+        self.width = None
+        self.height = None
+        self.source = None
+        self.labels = []
+        self.behaviors = []
+        self.track_ids = np.zeros(0, dtype=np.int64)
+        self.track_labels = np.zeros(0, dtype=np.int32)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.frame = np.zeros(0, dtype=np.int64)
+        self.track_id = np.zeros(0, dtype=np.int64)
+        self.xtl = np.zeros(0, dtype=np.float64)
+        self.ytl = np.zeros(0, dtype=np.float64)
+        self.xbr = np.zeros(0, dtype=np.float64)
+        self.ybr = np.zeros(0, dtype=np.float64)
+        self.keyframe = np.zeros(0, dtype=bool)
+        self.outside = np.zeros(0, dtype=bool)
+        self.label = np.zeros(0, dtype=np.int32)
+        self.point_offsets = np.zeros(1, dtype=np.int64)
+        self.point_frame = np.zeros(0, dtype=np.int64)
+        self.point_track_id = np.zeros(0, dtype=np.int64)
+        self.point_outside = np.zeros(0, dtype=bool)
+        self.point_label = np.zeros(0, dtype=np.int32)
+        self.behavior = np.zeros(0, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.frame)
+
+    def boxes(self):
+        """(N, 4) float64 array of xtl, ytl, xbr, ybr."""
+
+        return np.stack([self.xtl, self.ytl, self.xbr, self.ybr], axis=1)
+
+    def tracks(self):
+        """(track id, label, box rows, point rows) of every track in document order."""
+
+        offsets, point_offsets = self.offsets.tolist(), self.point_offsets.tolist()
+
+        for i, (track_id, label) in enumerate(zip(self.track_ids.tolist(), self.track_labels.tolist())):
+            yield (track_id, self.labels[label], slice(offsets[i], offsets[i + 1]),
+                   slice(point_offsets[i], point_offsets[i + 1]))
+
+    def behaviors_by_frame(self):
+        """Frame (as str, like the XML attribute) -> behavior of points that are not outside, later tracks win."""
+
+        annotated = {}
+
+        for frame_id, behavior in zip(self.point_frame[~self.point_outside].tolist(),
+                                      self.behavior[~self.point_outside].tolist()):
+            annotated[str(frame_id)] = None if behavior < 0 else self.behaviors[behavior]
+
+        return annotated
+
+    @staticmethod
+    def parse(filename):
+        """Parse the XML with iterparse, clearing elements once they are read."""
+
+        annotation = Annotation()
+        label2index = {}
+        behavior2index = {}
+        track_ids, track_labels, offsets = [], [], [0]
+        frame, track_id, xtl, ytl, xbr, ybr, keyframe, outside, label = [], [], [], [], [], [], [], [], []
+        point_offsets = [0]
+        point_frame, point_track_id, point_outside, point_label, behavior = [], [], [], [], []
+
+        current_id, current_label = None, None
+
+        for event, element in etree.iterparse(filename, events=("start", "end"),
+                                              tag=("box", "points", "track", "meta")):
+            tag = element.tag
+
+            if event == "start":
+                if tag == "track":
+                    current_id = int(element.get("id"))
+                    current_label = label2index.setdefault(element.get("label"), len(label2index))
+            elif tag == "box":
+                attributes = element.attrib
+                frame.append(int(attributes["frame"]))
+                track_id.append(current_id)
+                xtl.append(float(attributes["xtl"]))
+                ytl.append(float(attributes["ytl"]))
+                xbr.append(float(attributes["xbr"]))
+                ybr.append(float(attributes["ybr"]))
+                keyframe.append(attributes["keyframe"] == "1")
+                outside.append(attributes["outside"] == "1")
+                label.append(current_label)
+                element.clear()
+            elif tag == "points":
+                attribute = element.find("attribute")
+                point_frame.append(int(element.get("frame")))
+                point_track_id.append(current_id)
+                point_outside.append(element.get("outside") == "1")
+                point_label.append(current_label)
+
+                if attribute is None:
+                    behavior.append(-1)
+                else:
+                    behavior.append(behavior2index.setdefault("".join(attribute.itertext()), len(behavior2index)))
+
+                element.clear()
+            elif tag == "track":
+                track_ids.append(current_id)
+                track_labels.append(current_label)
+                offsets.append(len(frame))
+                point_offsets.append(len(point_frame))
+                element.clear()
+
+                # Drop finished tracks from the root as well.
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+            else:
+                Annotation.parse_meta(annotation, element)
+                element.clear()
+
+        annotation.labels = list(label2index.keys())
+        annotation.behaviors = list(behavior2index.keys())
+        annotation.track_ids = np.array(track_ids, dtype=np.int64)
+        annotation.track_labels = np.array(track_labels, dtype=np.int32)
+        annotation.offsets = np.array(offsets, dtype=np.int64)
+        annotation.frame = np.array(frame, dtype=np.int64)
+        annotation.track_id = np.array(track_id, dtype=np.int64)
+        annotation.xtl = np.array(xtl, dtype=np.float64)
+        annotation.ytl = np.array(ytl, dtype=np.float64)
+        annotation.xbr = np.array(xbr, dtype=np.float64)
+        annotation.ybr = np.array(ybr, dtype=np.float64)
+        annotation.keyframe = np.array(keyframe, dtype=bool)
+        annotation.outside = np.array(outside, dtype=bool)
+        annotation.label = np.array(label, dtype=np.int32)
+        annotation.point_offsets = np.array(point_offsets, dtype=np.int64)
+        annotation.point_frame = np.array(point_frame, dtype=np.int64)
+        annotation.point_track_id = np.array(point_track_id, dtype=np.int64)
+        annotation.point_outside = np.array(point_outside, dtype=bool)
+        annotation.point_label = np.array(point_label, dtype=np.int32)
+        annotation.behavior = np.array(behavior, dtype=np.int32)
+
+        return annotation
+
+    @staticmethod
+    def parse_meta(annotation, meta):
+        # Task exports keep everything in meta/task, job exports use meta/job and meta/original_size.
+        task = meta.find("task")
+
+        if task is None:
+            task = meta.find("job")
+            original_size = meta.find("original_size")
+        else:
+            original_size = task.find("original_size")
+
+        def text(element, tag):
+            if element is None or element.find(tag) is None:
+                return None
+
+            return "".join(element.find(tag).itertext())
+
+        size, width, height = text(task, "size"), text(original_size, "width"), text(original_size, "height")
+        annotation.size = None if size is None else int(size)
+        annotation.width = None if width is None else int(width)
+        annotation.height = None if height is None else int(height)
+        annotation.source = text(task, "source")
+
+    @staticmethod
+    def load(filename, cache_folder=cache_folder):
+        """Parse filename or reuse the arrays cached in cache_folder (None disables the cache).
+        The cache is valid while mtime and size match, otherwise while the content hash matches."""
+
+        if cache_folder is None:
+            return Annotation.parse(filename)
+
+        stat = os.stat(filename)
+        cache_path = Annotation.get_filename(cache_folder, filename)
+        sha1 = None
+
+        if os.path.exists(cache_path):
+            try:
+                annotation, cached = Annotation.load_cache(cache_path)
+            except Exception:
+                annotation, cached = None, None
+
+            if cached is not None and cached["version"] == Annotation.version and cached["size"] == stat.st_size:
+                if cached["mtime"] == stat.st_mtime_ns:
+                    return annotation
+
+                # Touched but maybe not changed.
+                sha1 = Annotation.get_hash(filename)
+
+                if cached["sha1"] == sha1:
+                    Annotation.save_cache(annotation, cache_path, stat, sha1)
+                    return annotation
+
+        annotation = Annotation.parse(filename)
+        Annotation.save_cache(annotation, cache_path, stat, Annotation.get_hash(filename) if sha1 is None else sha1)
+
+        return annotation
+
+    @staticmethod
+    def load_cache(cache_path):
+        # Columns stay memory-mapped until they are used.
+        data = load_npz(cache_path)
+        annotation = Annotation()
+
+        for column in Annotation.columns:
+            setattr(annotation, column, data[column])
+
+        annotation.labels = data["labels"].tolist()
+        annotation.behaviors = data["behaviors"].tolist()
+        meta = data["meta"].tolist()
+        annotation.size, annotation.width, annotation.height = [None if value < 0 else value for value in meta]
+        annotation.source = data["source"].item() if data["has_source"].item() else None
+        cached = {"version": data["version"].item(), "size": data["file_size"].item(),
+                  "mtime": data["mtime"].item(), "sha1": data["sha1"].item()}
+
+        return annotation, cached
+
+    @staticmethod
+    def save_cache(annotation, cache_path, stat, sha1):
+        """Cache the arrays of annotation, an unwritable cache folder only costs parsing again next time."""
+
+        meta = [-1 if value is None else value for value in (annotation.size, annotation.width, annotation.height)]
+        # Write to a temporary file first, so concurrent or interrupted runs never leave a broken cache.
+        temporary = f"{cache_path}.{os.getpid()}.tmp.npz"
+
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            np.savez(temporary, version=np.array(Annotation.version), file_size=np.array(stat.st_size),
+                     mtime=np.array(stat.st_mtime_ns), sha1=np.array(sha1),
+                     labels=np.array(annotation.labels, dtype=str), behaviors=np.array(annotation.behaviors, dtype=str),
+                     meta=np.array(meta, dtype=np.int64), source=np.array(annotation.source or ""),
+                     has_source=np.array(annotation.source is not None),
+                     **{column: getattr(annotation, column) for column in Annotation.columns})
+            os.replace(temporary, cache_path)
+        except OSError:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+    @staticmethod
+    def get_filename(folder, filename):
+        key = hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()
+
+        return f"{folder}/{os.path.splitext(os.path.basename(filename))[0]}_{key[:16]}.npz"
+
+    @staticmethod
+    def get_hash(filename):
+        sha1 = hashlib.sha1()
+
+        with open(filename, "rb") as file:
+            for chunk in iter(lambda: file.read(16 * 1024 * 1024), b""):
+                sha1.update(chunk)
+
+        return sha1.hexdigest()
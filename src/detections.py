@@ -0,0 +1,42 @@
+import numpy as np
+
+
+class Detections:
+    """Detections of one frame stored as arrays.
+    boxes are (N, 4) int32 pixel coordinates, scores are (N,) float32,
+    class_ids are (N,) int32 indices into labels."""
+
+    def __init__(self, boxes, scores, class_ids, labels):
+        self.boxes = np.asarray(boxes, dtype=np.int32).reshape(-1, 4)
+        self.scores = np.asarray(scores, dtype=np.float32).reshape(-1)
+        self.class_ids = np.asarray(class_ids, dtype=np.int32).reshape(-1)
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def select(self, indices):
+        return Detections(self.boxes[indices], self.scores[indices], self.class_ids[indices], self.labels)
+
+    def centroids(self):
+        """Centroids rounded the same way as YOLOv8.get_centroid."""
+
+        x = (self.boxes[:, 0] + (self.boxes[:, 2] - self.boxes[:, 0]) / 2).astype(np.int64)
+        y = (self.boxes[:, 1] + (self.boxes[:, 3] - self.boxes[:, 1]) / 2).astype(np.int64)
+
+        return np.stack((x, y), axis=1)
+
+    def to_list(self):
+        """Adapter to the ([x_start, y_start, x_end, y_end], confidence, label) list format."""
+
+        return [(box, round(score, 2), self.labels[class_id]) for box, score, class_id in
+                zip(self.boxes.tolist(), self.scores.tolist(), self.class_ids.tolist())]
+
+    @staticmethod
+    def concatenate(detections, labels):
+        if len(detections) == 0:
+            return Detections(np.zeros((0, 4)), np.zeros(0), np.zeros(0), labels)
+
+        return Detections(np.concatenate([entry.boxes for entry in detections]),
+                          np.concatenate([entry.scores for entry in detections]),
+                          np.concatenate([entry.class_ids for entry in detections]), labels)
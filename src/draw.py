@@ -85,9 +85,10 @@ class Draw:
     @staticmethod
     def track(image, centroids, color, history):
         start = np.max([1, len(centroids) - history])
+        points = [tuple(point) for point in np.asarray(centroids)[start - 1:].tolist()]
         faded = tuple([i - 30 for i in color])
-        cv2.circle(image, centroids[-1], 10, faded, -1)
+        cv2.circle(image, points[-1], 10, faded, -1)
 
-        for i in range(start, len(centroids)):
-            thickness = int(np.sqrt(64 * float(i - start + 1)) / 5)
-            cv2.line(image, tuple(centroids[i - 1]), tuple(centroids[i]), color, thickness)
+        for i in range(1, len(points)):
+            thickness = int(np.sqrt(64 * float(i)) / 5)
+            cv2.line(image, points[i - 1], points[i], color, thickness)
@@ -0,0 +1,139 @@
+import os
+import shutil
+import subprocess
+import threading
+from collections import OrderedDict
+import cv2
+from src.pipeline import Channel
+
+
+class EncoderPool:
+    """Writes frames of many videos {folder}/{key}.mp4 in background threads.
+    Every key is hashed to one of workers encoder threads fed by a bounded Channel, so frames of a video
+    stay in order and the caller only waits when all queues are full.
+    At most max_open writers are open at once: the least recently written video is released and continues
+    in a new segment file when it gets frames again, segments are concatenated by close."""
+
+    def __init__(self, folder, size, fps=29.97, workers=2, max_open=64, maxsize=64):
+        self.folder = folder
+        self.size = size
+        self.fps = fps
+        self.workers = max(1, workers)
+        self.max_open = max(1, max_open // self.workers)
+        self.stop = threading.Event()
+        self.channels = [Channel(maxsize, self.stop) for _ in range(self.workers)]
+        # Segment files of every key, filled by the workers.
+        self.segments = OrderedDict()
+        self.lock = threading.Lock()
+        self.error = None
+        self.threads = [threading.Thread(target=self.run, args=(channel,), daemon=True)
+                        for channel in self.channels]
+
+        for thread in self.threads:
+            thread.start()
+
+    def write(self, key, frame):
+        """Queue frame of video key, frame must not be modified afterwards."""
+
+        self.check()
+        self.channels[hash(key) % self.workers].put((key, frame))
+
+    def run(self, channel):
+        writers = OrderedDict()
+
+        try:
+            for key, frame in channel:
+                if self.stop.is_set():
+                    break
+
+                writer = writers.get(key)
+
+                if writer is None:
+                    if len(writers) >= self.max_open:
+                        _, oldest = writers.popitem(last=False)
+                        oldest.release()
+
+                    writer = cv2.VideoWriter(self.add_segment(key), cv2.VideoWriter_fourcc("m", "p", "4", "v"),
+                                             self.fps, self.size)
+                    writers[key] = writer
+                else:
+                    writers.move_to_end(key)
+
+                writer.write(frame)
+        except BaseException as error:
+            self.error = error
+            self.stop.set()
+        finally:
+            for writer in writers.values():
+                writer.release()
+
+    def add_segment(self, key):
+        with self.lock:
+            segments = self.segments.setdefault(key, [])
+            segments.append(f"{self.folder}/{key}.part{len(segments)}.mp4")
+
+            return segments[-1]
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """Wait for queued frames and join segments into {folder}/{key}.mp4."""
+
+        for channel in self.channels:
+            channel.close()
+
+        for thread in self.threads:
+            thread.join()
+
+        self.check()
+
+        for key, segments in self.segments.items():
+            filename = f"{self.folder}/{key}.mp4"
+
+            if len(segments) == 1:
+                os.replace(segments[0], filename)
+            else:
+                EncoderPool.concatenate(segments, filename, self.fps, self.size)
+
+                for segment in segments:
+                    os.remove(segment)
+
+    @staticmethod
+    def concatenate(segments, filename, fps, size):
+        """Join segments without re-encoding when ffmpeg is installed, otherwise decode and encode them again."""
+
+        if shutil.which("ffmpeg") is not None:
+            listing = f"{filename}.txt"
+
+            with open(listing, "w") as file:
+                for segment in segments:
+                    path = os.path.abspath(segment).replace("'", "'\\''")
+                    file.write(f"file '{path}'\n")
+
+            try:
+                subprocess.run(["ffmpeg", "-v", "quiet", "-y", "-f", "concat", "-safe", "0", "-i", listing,
+                                "-c", "copy", filename], check=True)
+                return
+            except subprocess.CalledProcessError:
+                pass
+            finally:
+                os.remove(listing)
+
+        writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc("m", "p", "4", "v"), fps, size)
+
+        for segment in segments:
+            reader = cv2.VideoCapture(segment)
+
+            while True:
+                returned, frame = reader.read()
+
+                if not returned:
+                    break
+
+                writer.write(frame)
+
+            reader.release()
+
+        writer.release()
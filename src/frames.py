@@ -0,0 +1,52 @@
+import itertools
+import numpy as np
+import cv2
+
+
+class FrameReader:
+    """Iterates over (index, frame) of the needed frames of a video only.
+    The capture seeks to the first needed frame, frames in between needed ones are grab()bed without
+    being decoded and reading stops after the last needed frame. frames=None reads the whole video.
+    Gaps longer than max_grab frames are seeked over as well (None never seeks after the first frame)."""
+
+    def __init__(self, vc, frames=None, max_grab=None):
+        self.vc = vc
+        self.frames = None if frames is None else np.unique(np.asarray(frames, dtype=np.int64)).tolist()
+        self.max_grab = max_grab
+        # Index of the frame the next read returns.
+        self.position = int(vc.get(cv2.CAP_PROP_POS_FRAMES))
+
+    def __iter__(self):
+        frames = itertools.count(self.position) if self.frames is None else self.frames
+        first = True
+
+        for index in frames:
+            if index < self.position:
+                continue
+
+            gap = index - self.position
+
+            if gap > 0 and (first or (self.max_grab is not None and gap > self.max_grab)):
+                self.vc.set(cv2.CAP_PROP_POS_FRAMES, index)
+            else:
+                for _ in range(gap):
+                    if not self.vc.grab():
+                        return
+
+            returned, frame = self.vc.read()
+
+            if not returned:
+                return
+
+            self.position = index + 1
+            first = False
+
+            yield index, frame
+
+    @staticmethod
+    def annotated(annotation, step=1):
+        """Frames of the boxes of a CVAT Annotation, only multiples of step."""
+
+        frames = np.unique(annotation.frame)
+
+        return frames[frames % step == 0]
@@ -0,0 +1,111 @@
+import numpy as np
+from src.tracker import Tracker, Track
+
+
+class Linker:
+    """Offline linking of track fragments over the whole video.
+    The end of every fragment is extrapolated with its recent velocity and matched to fragment starts
+    up to max_gap frames later and max_distance pixels away, globally with the Hungarian algorithm.
+    Linked fragments are merged into the first one, gaps get linear centroids and interpolated boxes."""
+
+    def __init__(self, max_gap, max_distance, window=10):
+        self.max_gap = max_gap
+        self.max_distance = max_distance
+        # Points at the end of a fragment used for its velocity.
+        self.window = window
+
+    def link(self, tracks):
+        """Merge linked tracks, returns the merged tracks in the order of their first fragment."""
+
+        tracks = [track for track in tracks if track.has_box.any()]
+
+        if len(tracks) == 0:
+            return tracks
+
+        first = np.array([np.argmax(track.has_box) for track in tracks])
+        last = np.array([len(track) - 1 - np.argmax(track.has_box[::-1]) for track in tracks])
+        start_frames = np.array([track.indices[i] for track, i in zip(tracks, first)], dtype=np.int64)
+        end_frames = np.array([track.indices[i] for track, i in zip(tracks, last)], dtype=np.int64)
+        start_positions = np.array([track.centroids[i] for track, i in zip(tracks, first)], dtype=np.float64)
+        end_positions = np.array([track.centroids[i] for track, i in zip(tracks, last)], dtype=np.float64)
+        velocities = np.array([self.get_velocity(track, i) for track, i in zip(tracks, last)], dtype=np.float64)
+        labels = [track.label for track in tracks]
+
+        # Candidate starts of every end lie in (end frame, end frame + max_gap].
+        order = np.argsort(start_frames, kind="stable")
+        sorted_frames = start_frames[order]
+        low = np.searchsorted(sorted_frames, end_frames, side="right")
+        high = np.searchsorted(sorted_frames, end_frames + self.max_gap, side="right")
+        counts = high - low
+        rows = np.repeat(np.arange(len(tracks)), counts)
+        cols = order[np.repeat(low, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)]
+        gaps = start_frames[cols] - end_frames[rows]
+        predicted = end_positions[rows] + velocities[rows] * gaps[:, None]
+        costs = np.linalg.norm(predicted - start_positions[cols], axis=1)
+        # Fragments of different classes are never linked.
+        same_label = np.array([labels[row] is None or labels[col] is None or labels[row] == labels[col]
+                               for row, col in zip(rows.tolist(), cols.tolist())], dtype=bool)
+        valid = (costs <= self.max_distance) & same_label
+        row_ind, col_ind = Tracker.match(rows[valid], cols[valid], costs[valid], len(tracks), len(tracks),
+                                         self.max_distance)
+        following = dict(zip(row_ind.tolist(), col_ind.tolist()))
+        linked = set(following.values())
+        merged = []
+
+        for head in range(len(tracks)):
+            if head in linked:
+                continue
+
+            chain = [head]
+
+            while chain[-1] in following:
+                chain.append(following[chain[-1]])
+
+            if len(chain) == 1:
+                merged.append(tracks[head])
+            else:
+                merged.append(self.merge([tracks[i] for i in chain], first[chain], last[chain]))
+
+        return merged
+
+    def get_velocity(self, track, last):
+        indices = np.flatnonzero(track.has_box[:last + 1])[-self.window:]
+
+        if len(indices) < 2 or track.indices[indices[-1]] == track.indices[indices[0]]:
+            return np.zeros(2)
+
+        return ((track.centroids[indices[-1]] - track.centroids[indices[0]]) /
+                (track.indices[indices[-1]] - track.indices[indices[0]]))
+
+    @staticmethod
+    def merge(chain, first, last):
+        """One track from fragments, each cut to its points from the first to the last box."""
+
+        indices, centroids, boxes, interpolated, has_box = [], [], [], [], []
+
+        for i, (track, start, end) in enumerate(zip(chain, first, last)):
+            if i > 0:
+                # Gap between the previous fragment and this one.
+                previous_index, previous_centroid = indices[-1][-1], centroids[-1][-1]
+                gap = np.arange(previous_index + 1, track.indices[start])
+                weights = ((gap - previous_index) / (track.indices[start] - previous_index))[:, None]
+                indices.append(gap)
+                centroids.append(previous_centroid + weights * (track.centroids[start] - previous_centroid))
+                boxes.append(np.zeros((len(gap), 4), dtype=np.int32))
+                interpolated.append(np.ones(len(gap), dtype=bool))
+                has_box.append(np.zeros(len(gap), dtype=bool))
+
+            rows = slice(start, end + 1)
+            indices.append(track.indices[rows])
+            centroids.append(track.centroids[rows])
+            boxes.append(track.boxes[rows])
+            interpolated.append(track.interpolated[rows])
+            has_box.append(track.has_box[rows])
+
+        label = next((track.label for track in chain if track.label is not None), None)
+        track = Track.from_arrays(chain[0].object_id, chain[0].color, label, np.concatenate(indices),
+                                  np.concatenate(centroids).astype(np.int32), np.concatenate(boxes),
+                                  np.concatenate(interpolated), np.concatenate(has_box))
+        track.interpolate()
+
+        return track
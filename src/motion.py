@@ -0,0 +1,69 @@
+import math
+import numpy as np
+import cv2
+
+
+class MotionGate:
+    """Decides whether a frame is close enough to the last detected frame to skip detection on it.
+    Frames are compared in grayscale downsampled to width pixels: the global camera shift comes from
+    cv2.phaseCorrelate and the change is the largest mean absolute difference (0-255) of any block x block
+    pixels left after undoing the shift, so a few moving animals count even when the background is still.
+    At least every max_skipped + 1 frames are detected, so slowly appearing animals are not missed."""
+
+    def __init__(self, threshold, width=640, max_skipped=30, block=16):
+        self.threshold = threshold
+        self.width = width
+        self.max_skipped = max_skipped
+        self.block = block
+        self.reference = None
+        self.skipped_in_row = 0
+        self.skipped = 0
+        self.total = 0
+
+    def prepare(self, frame):
+        height = max(1, int(round(frame.shape[0] * self.width / frame.shape[1])))
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+        return cv2.resize(gray, (self.width, height), interpolation=cv2.INTER_AREA).astype(np.float32)
+
+    def skip(self, frame):
+        """True when the frame does not need detection, otherwise the frame becomes the new reference."""
+
+        small = self.prepare(frame)
+        self.total += 1
+
+        if self.reference is not None and self.reference.shape == small.shape \
+                and self.skipped_in_row < self.max_skipped:
+            (dx, dy), _ = cv2.phaseCorrelate(self.reference, small)
+            aligned = cv2.warpAffine(small, np.float32([[1, 0, -dx], [0, 1, -dy]]),
+                                     (small.shape[1], small.shape[0]))
+            # Borders uncovered by the shift are not compared.
+            margin = int(math.ceil(max(abs(dx), abs(dy)))) + 1
+
+            if 2 * margin < min(small.shape):
+                difference = np.abs(aligned[margin:-margin, margin:-margin] -
+                                    self.reference[margin:-margin, margin:-margin])
+                change = self.get_change(difference)
+
+                if change < self.threshold:
+                    self.skipped_in_row += 1
+                    self.skipped += 1
+
+                    return True
+
+        self.reference = small
+        self.skipped_in_row = 0
+
+        return False
+
+    def get_change(self, difference):
+        """Largest mean of difference over blocks, partial blocks at the borders are dropped."""
+
+        rows, cols = difference.shape[0] // self.block, difference.shape[1] // self.block
+
+        if rows == 0 or cols == 0:
+            return float(np.mean(difference))
+
+        blocks = difference[:rows * self.block, :cols * self.block].reshape(rows, self.block, cols, self.block)
+
+        return float(blocks.mean(axis=(1, 3)).max())
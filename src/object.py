@@ -1,36 +1,29 @@
-import numpy as np
-
-
 class Object:
-    def __init__(self, object_id, centroid, color, attribute=None):
+    __slots__ = ("object_id", "centroid", "color", "box", "confidence", "label")
+
+    def __init__(self, object_id, centroid, color, box=None, confidence=None, label=None):
         self.object_id = object_id
         self.centroid = centroid
         self.color = color
-        self.attribute = attribute
-
-    def __getattr__(self, name):
-        if self.attribute is None:
-            return None
-
-        if self.attribute.get(name) is None:
-            return None
-        else:
-            return self.attribute[name]
+        self.box = box
+        self.confidence = confidence
+        self.label = label
 
     @staticmethod
-    def object_factory(objects, centroids, colors, attributes):
+    def from_assignment(objects, colors, assignment, predictions):
+        """Build objects from the object id -> prediction index mapping returned by Tracker.update.
+        predictions are (box, confidence, label) tuples, confidence and label may be None."""
+
         entities = []
 
         for object_id, centroid in objects.items():
-            assigned = False
-
-            for i, c in enumerate(centroids):
-                if np.array_equal(centroid, c):
-                    entities.append(Object(object_id, centroid, colors[object_id], attributes[i]))
-                    assigned = True
+            index = assignment.get(object_id)
 
-            if not assigned:
+            if index is None:
                 # Object disappeared for some frames.
-                entities.append(Object(object_id, centroid, colors[object_id], None))
+                entities.append(Object(object_id, centroid, colors[object_id]))
+            else:
+                box, confidence, label = predictions[index]
+                entities.append(Object(object_id, centroid, colors[object_id], box, confidence, label))
 
         return entities
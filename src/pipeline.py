@@ -0,0 +1,88 @@
+import queue
+import threading
+
+
+class Channel:
+    """Bounded queue between pipeline stages. Iterating over it yields items until it is closed.
+    After stop is set, put drops items instead of blocking so producers can finish."""
+
+    _end = object()
+
+    def __init__(self, maxsize=4, stop=None):
+        self.queue = queue.Queue(maxsize)
+        self.stop = stop if stop is not None else threading.Event()
+
+    def put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def close(self):
+        while True:
+            try:
+                self.queue.put(Channel._end, timeout=0.1)
+                return
+            except queue.Full:
+                # Nobody reads anymore, make room for the end marker.
+                if self.stop.is_set():
+                    try:
+                        self.queue.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+
+            if item is Channel._end:
+                return
+
+            yield item
+
+
+class Stage(threading.Thread):
+    """Apply function to every item of source in a background thread.
+    Results are passed to the next stage through a bounded Channel, unless the stage is a sink.
+    An exception raised by function is re-raised in the thread iterating over the stage."""
+
+    def __init__(self, function, source, maxsize=4, stop=None, sink=False):
+        super().__init__(daemon=True)
+        self.function = function
+        self.source = source
+        self.stop = stop if stop is not None else threading.Event()
+        self.output = None if sink else Channel(maxsize, self.stop)
+        self.error = None
+
+    def run(self):
+        try:
+            for item in self.source:
+                if self.stop.is_set():
+                    break
+
+                result = self.function(item)
+
+                if self.output is not None:
+                    self.output.put(result)
+
+            # The upstream stage may have stopped the pipeline because of an error.
+            if isinstance(self.source, Stage):
+                self.source.check()
+        except BaseException as error:
+            self.error = error
+            self.stop.set()
+        finally:
+            if self.output is not None:
+                self.output.close()
+
+    def __iter__(self):
+        yield from self.output
+        self.check()
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
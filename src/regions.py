@@ -0,0 +1,76 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from src.yolo import YOLOv8
+
+
+class Regions:
+    """Chooses where the detector looks: the whole frame on every full_scan-th detected frame,
+    otherwise windows of size pixels around the known animals grown by padding.
+    An animal missed in its window keeps it for max_missed detected frames, moved by its last displacement.
+    New animals are found by the next full scan."""
+
+    def __init__(self, full_scan, size, padding, max_missed=10):
+        self.full_scan = max(1, full_scan)
+        self.size = size
+        self.padding = padding
+        self.max_missed = max_missed
+        self.count = 0
+        # Boxes of the known animals at the last update, their displacement per detected frame
+        # and the number of detected frames they were missed on.
+        self.boxes = None
+        self.velocities = None
+        self.missed = None
+        # Frames planned but not updated yet.
+        self.pending = 0
+        self.full = 0
+        self.crops = 0
+
+    def plan(self, width, height):
+        """None for a full frame scan, otherwise (x_start, y_start, x_end, y_end) regions of the next detected frame.
+        Frames are planned and updated in the same order."""
+
+        full = self.boxes is None or self.count % self.full_scan == 0
+        self.count += 1
+        self.pending += 1
+
+        if full:
+            self.full += 1
+            return None
+
+        boxes = self.boxes + np.tile(self.velocities * self.pending, 2)
+        regions = YOLOv8.get_regions(np.round(boxes).astype(np.int64), width, height, self.size, self.padding)
+        self.crops += len(regions)
+
+        return regions
+
+    def update(self, detections):
+        """Known animals after the detections of the next planned frame."""
+
+        self.pending = max(0, self.pending - 1)
+        boxes = detections.boxes.astype(np.float64)
+        velocities = np.zeros((len(boxes), 2))
+
+        if self.boxes is None:
+            self.boxes, self.velocities, self.missed = boxes, velocities, np.zeros(len(boxes), dtype=np.int64)
+            return
+
+        predicted = self.boxes + np.tile(self.velocities, 2)
+        kept = self.missed < self.max_missed
+
+        if len(boxes) > 0 and len(predicted) > 0:
+            centroids = Regions.centroids(boxes)
+            distance = self.size / 2
+            # Known animals without a detection close to where they were expected were missed.
+            distances, _ = cKDTree(centroids).query(Regions.centroids(predicted), distance_upper_bound=distance)
+            kept &= ~np.isfinite(distances)
+            distances, nearest = cKDTree(Regions.centroids(predicted)).query(centroids, distance_upper_bound=distance)
+            matched = np.isfinite(distances)
+            velocities[matched] = centroids[matched] - Regions.centroids(self.boxes[nearest[matched]])
+
+        self.boxes = np.concatenate((boxes, predicted[kept]))
+        self.velocities = np.concatenate((velocities, self.velocities[kept]))
+        self.missed = np.concatenate((np.zeros(len(boxes), dtype=np.int64), self.missed[kept] + 1))
+
+    @staticmethod
+    def centroids(boxes):
+        return (boxes[:, :2] + boxes[:, 2:]) / 2
@@ -0,0 +1,38 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+class Stride:
+    """Chooses the frames the detector runs on: every stride-th frame, or more often while animals move fast.
+    With max_shift > 0 the step shrinks so that the fastest detections (90th percentile of the displacement
+    of centroids matched to the previous detected frame) move at most max_shift pixels between detections."""
+
+    def __init__(self, stride, max_shift=0, max_distance=300):
+        self.stride = max(1, stride)
+        self.max_shift = max_shift
+        self.max_distance = max_distance
+        self.current = self.stride
+        self.next = 0
+        self.last_index = None
+        self.last_centroids = None
+
+    def plan(self, start, size):
+        """Indices of frames start..start + size - 1 to detect with the current step."""
+
+        return list(range(max(self.next, start), start + size, self.current))
+
+    def update(self, index, centroids):
+        """Adapt the step to detections of frame index."""
+
+        if self.max_shift > 0 and self.last_centroids is not None and len(self.last_centroids) > 0 \
+                and len(centroids) > 0:
+            distances, _ = cKDTree(self.last_centroids).query(centroids, distance_upper_bound=self.max_distance)
+            distances = distances[np.isfinite(distances)]
+
+            if len(distances) > 0:
+                speed = np.percentile(distances, 90) / (index - self.last_index)
+                self.current = self.stride if speed == 0 else int(np.clip(self.max_shift / speed, 1, self.stride))
+
+        self.last_index = index
+        self.last_centroids = centroids
+        self.next = index + self.current
@@ -1,10 +1,16 @@
+import os
+import gzip
+import heapq
 import numpy as np
 from collections import OrderedDict
-from scipy.spatial import distance
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from scipy.optimize import linear_sum_assignment
 from lxml import etree
+from src.cvat import Annotation
+from src.utils import load_npz
 import json
-import cv2
 
 
 class Tracker:
@@ -38,36 +44,45 @@ class Tracker:
         self.next_object_id = 1
         self.objects = OrderedDict()
         self.disappeared = OrderedDict()
-        self.kalman_filters = OrderedDict()
+        self.kalman = KalmanBank()
+        self.slots = OrderedDict()
         self.colors = OrderedDict()
         self.max_disappeared = max_disappeared
         self.max_distance = max_distance
 
     def add(self, centroid):
-        """Add new object."""
+        """Add new object and return its id."""
 
-        self.objects[self.next_object_id] = np.array(centroid)
-        self.disappeared[self.next_object_id] = 0
-        self.kalman_filters[self.next_object_id] = KalmanFiler()
+        object_id = self.next_object_id
+        self.objects[object_id] = np.array(centroid)
+        self.disappeared[object_id] = 0
+        self.slots[object_id] = self.kalman.add()
         colors_values = list(Tracker.colors_table.values())
-        self.colors[self.next_object_id] = colors_values[self.next_object_id % len(colors_values)]
+        self.colors[object_id] = colors_values[object_id % len(colors_values)]
         self.next_object_id += 1
 
+        return object_id
+
     def delete(self, object_id):
         """Delete disappeared object."""
 
         del self.objects[object_id]
         del self.disappeared[object_id]
-        del self.kalman_filters[object_id]
+        self.kalman.delete(self.slots.pop(object_id))
 
-    def update(self, centroids):
-        """Update tracks on a new frame."""
+    def update(self, centroids, return_assignment=False):
+        """Update tracks on a new frame.
+        return_assignment additionally returns an object id -> centroid index mapping
+        for objects matched to (or created from) a centroid on this frame."""
 
         centroids = np.array(centroids)
+        assignment = OrderedDict()
+
+        if len(self.objects) > 0:
+            predicted = self.kalman.predict(list(self.slots.values()), list(self.objects.values()))
 
-        for object_id in self.objects.keys():
-            self.objects[object_id] = self.kalman_filters[object_id].predict(self.objects[object_id][0],
-                                                                             self.objects[object_id][1])
+            for object_id, position in zip(self.objects.keys(), predicted):
+                self.objects[object_id] = position
 
         if len(centroids) == 0:
             keys = list(self.disappeared.keys())
@@ -77,37 +92,28 @@ class Tracker:
 
                 if self.disappeared[object_id] > self.max_disappeared:
                     self.delete(object_id)
-
-            return self.objects, self.colors
-
-        if len(self.objects) == 0:
+        elif len(self.objects) == 0:
             for i in range(0, len(centroids)):
-                self.add(centroids[i])
+                assignment[self.add(centroids[i])] = i
         else:
             object_ids = list(self.objects.keys())
-            object_centroids = list(self.objects.values())
-            Y = distance.cdist(np.array(object_centroids), centroids)
-            row_ind, col_ind = linear_sum_assignment(Y)
+            object_centroids = np.array(list(self.objects.values()))
+            row_ind, col_ind = self.assign(object_centroids, centroids)
             used_rows = set()
             used_cols = set()
 
             for row, col in zip(row_ind, col_ind):
-                if row in used_rows or col in used_cols:
-                    continue
-
-                if Y[row, col] > self.max_distance:
-                    continue
-
                 object_id = object_ids[row]
                 self.objects[object_id] = centroids[col]
                 self.disappeared[object_id] = 0
+                assignment[object_id] = col
                 used_rows.add(row)
                 used_cols.add(col)
 
-            unused_rows = set(range(0, Y.shape[0])).difference(used_rows)
-            unused_cols = set(range(0, Y.shape[1])).difference(used_cols)
+            unused_rows = set(range(0, len(object_ids))).difference(used_rows)
+            unused_cols = set(range(0, len(centroids))).difference(used_cols)
 
-            if Y.shape[0] >= Y.shape[1]:
+            if len(object_ids) >= len(centroids):
                 for row in unused_rows:
                     object_id = object_ids[row]
                     self.disappeared[object_id] += 1
@@ -116,71 +122,393 @@ class Tracker:
                         self.delete(object_id)
             else:
                 for col in unused_cols:
-                    self.add(centroids[col])
+                    assignment[self.add(centroids[col])] = col
+
+        if return_assignment:
+            return self.objects, self.colors, assignment
 
         return self.objects, self.colors
 
+    def get_state(self):
+        """JSON serializable state of the tracked objects, restored by set_state."""
+
+        objects = [{"object_id": object_id, "centroid": np.asarray(centroid).tolist(),
+                    "disappeared": self.disappeared[object_id], "color": list(self.colors[object_id]),
+                    "kalman": self.kalman.get(self.slots[object_id])}
+                   for object_id, centroid in self.objects.items()]
+
+        return {"next_object_id": self.next_object_id, "objects": objects}
+
+    def set_state(self, state):
+        self.reset()
+        self.next_object_id = state["next_object_id"]
+
+        for value in state["objects"]:
+            object_id = value["object_id"]
+            self.objects[object_id] = np.array(value["centroid"])
+            self.disappeared[object_id] = value["disappeared"]
+            self.colors[object_id] = tuple(value["color"])
+            self.slots[object_id] = self.kalman.add()
+            self.kalman.set(self.slots[object_id], value["kalman"])
+
+    def assign(self, object_centroids, centroids):
+        """Match objects to centroids not farther than max_distance.
+        Candidate pairs come from a KD-tree and every connected component of the candidate graph
+        is solved on its own: directly when one side has a single member, with the Hungarian algorithm otherwise.
+        Returns matched object rows and centroid columns."""
+
+        pairs = cKDTree(object_centroids).sparse_distance_matrix(cKDTree(centroids), self.max_distance,
+                                                                 output_type="ndarray")
+
+        return Tracker.match(pairs["i"], pairs["j"], pairs["v"], len(object_centroids), len(centroids),
+                            self.max_distance)
+
+    @staticmethod
+    def match(rows, cols, costs, n_rows, n_cols, max_cost):
+        """Minimum cost one-to-one matching of the candidate pairs (rows[k], cols[k]) with costs[k] <= max_cost.
+        Returns matched rows and columns."""
+
+        if len(rows) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        n = n_rows
+        size = n + n_cols
+        graph = coo_matrix((np.ones(len(rows)), (rows, n + cols)), shape=(size, size))
+        _, components = connected_components(graph, directed=False)
+        edge_components = components[rows]
+        # Components made of a single pair are matched directly.
+        single = np.bincount(edge_components)[edge_components] == 1
+        row_ind = list(rows[single])
+        col_ind = list(cols[single])
+        rows, cols, costs, edge_components = rows[~single], cols[~single], costs[~single], edge_components[~single]
+        order = np.argsort(edge_components, kind="stable")
+        rows, cols, costs = rows[order], cols[order], costs[order]
+        splits = np.flatnonzero(np.diff(edge_components[order])) + 1
+
+        for component_rows, component_cols, component_costs in zip(np.split(rows, splits), np.split(cols, splits),
+                                                                   np.split(costs, splits)):
+            if len(component_rows) == 0:
+                continue
+
+            unique_rows, local_rows = np.unique(component_rows, return_inverse=True)
+            unique_cols, local_cols = np.unique(component_cols, return_inverse=True)
+
+            if len(unique_rows) == 1 or len(unique_cols) == 1:
+                # Star component: the closest pair is the optimal assignment.
+                best = np.argmin(component_costs)
+                row_ind.append(component_rows[best])
+                col_ind.append(component_cols[best])
+                continue
+
+            # Missing edges cost more than any assignment of real ones, so they are never preferred.
+            missing = max_cost * (min(len(unique_rows), len(unique_cols)) + 1) + 1
+            Y = np.full((len(unique_rows), len(unique_cols)), missing, dtype=np.float64)
+            Y[local_rows, local_cols] = component_costs
+            local_row_ind, local_col_ind = linear_sum_assignment(Y)
+            matched = Y[local_row_ind, local_col_ind] <= max_cost
+            row_ind.extend(unique_rows[local_row_ind[matched]])
+            col_ind.extend(unique_cols[local_col_ind[matched]])
+
+        return np.array(row_ind, dtype=np.int64), np.array(col_ind, dtype=np.int64)
+
     def reset(self):
         """Reset tracker to default state."""
 
         self.next_object_id = 0
         self.objects = OrderedDict()
         self.disappeared = OrderedDict()
+        self.kalman = KalmanBank()
+        self.slots = OrderedDict()
         self.colors = OrderedDict()
 
 
-class KalmanFiler:
-    def __init__(self):
-        self.kalman_filter = cv2.KalmanFilter(4, 2)
-        self.kalman_filter.measurementMatrix = np.array([[1, 0, 0, 0],
-                                                         [0, 1, 0, 0]], dtype=np.float32)
-        self.kalman_filter.transitionMatrix = np.array([[1, 0, 0.01, 0],
-                                                        [0, 1, 0, 0.01],
-                                                        [0, 0, 1, 0],
-                                                        [0, 0, 0, 1]], dtype=np.float32)
-        self.initial_x = None
-        self.initial_y = None
+class KalmanBank:
+    """Constant-velocity Kalman filters of all tracks stored in stacked arrays.
+    Same model as one cv2.KalmanFilter(4, 2) per track with default noise covariances:
+    a filter is anchored at the first position it sees and every later step corrects it
+    with the current position and predicts the next one."""
+
+    transition = np.array([[1, 0, 0.01, 0],
+                           [0, 1, 0, 0.01],
+                           [0, 0, 1, 0],
+                           [0, 0, 0, 1]], dtype=np.float32)
+    measurement = np.array([[1, 0, 0, 0],
+                            [0, 1, 0, 0]], dtype=np.float32)
+    process_noise = np.eye(4, dtype=np.float32)
+    measurement_noise = np.eye(2, dtype=np.float32)
+
+    def __init__(self, capacity=64):
+        self.state = np.zeros((capacity, 4), dtype=np.float32)
+        self.covariance = np.zeros((capacity, 4, 4), dtype=np.float32)
+        self.initial = np.zeros((capacity, 2), dtype=np.int64)
+        self.initialized = np.zeros(capacity, dtype=bool)
+        self.free = list(range(capacity - 1, -1, -1))
+
+    def add(self):
+        """Allocate a filter and return its slot."""
+
+        if len(self.free) == 0:
+            self.grow()
+
+        slot = self.free.pop()
+        self.state[slot] = 0
+        self.covariance[slot] = 0
+        self.initialized[slot] = False
+
+        return slot
+
+    def delete(self, slot):
+        self.free.append(slot)
+
+    def get(self, slot):
+        return {"state": self.state[slot].tolist(), "covariance": self.covariance[slot].tolist(),
+                "initial": self.initial[slot].tolist(), "initialized": bool(self.initialized[slot])}
+
+    def set(self, slot, value):
+        self.state[slot] = value["state"]
+        self.covariance[slot] = value["covariance"]
+        self.initial[slot] = value["initial"]
+        self.initialized[slot] = value["initialized"]
+
+    def grow(self):
+        capacity = len(self.state)
+        self.state = np.concatenate((self.state, np.zeros_like(self.state)))
+        self.covariance = np.concatenate((self.covariance, np.zeros_like(self.covariance)))
+        self.initial = np.concatenate((self.initial, np.zeros_like(self.initial)))
+        self.initialized = np.concatenate((self.initialized, np.zeros_like(self.initialized)))
+        self.free.extend(range(2 * capacity - 1, capacity - 1, -1))
+
+    def predict(self, slots, positions):
+        """Correct filters in slots with positions (N, 2) and return predicted positions (N, 2)."""
+
+        slots = np.asarray(slots, dtype=np.int64)
+        positions = np.asarray(positions, dtype=np.int64).reshape(-1, 2)
+        predicted = positions.copy()
+        first = ~self.initialized[slots]
+
+        if np.any(first):
+            self.initial[slots[first]] = positions[first]
+            self.initialized[slots[first]] = True
+
+        slots = slots[~first]
+
+        if len(slots) == 0:
+            return predicted
+
+        F, H = KalmanBank.transition, KalmanBank.measurement
+        state = self.state[slots]
+        covariance = self.covariance[slots]
+        residual = (positions[~first] - self.initial[slots]).astype(np.float32) - state @ H.T
+        # Gain K = P H^T (H P H^T + R)^-1 for all filters at once.
+        innovation = H @ covariance @ H.T + KalmanBank.measurement_noise
+        gain = covariance @ H.T @ np.linalg.inv(innovation)
+        state = state + (gain @ residual[:, :, None])[:, :, 0]
+        covariance = covariance - gain @ H @ covariance
+        state = state @ F.T
+        covariance = F @ covariance @ F.T + KalmanBank.process_noise
+        self.state[slots] = state
+        self.covariance[slots] = covariance
+        predicted[~first] = np.trunc(state[:, :2]).astype(np.int64) + self.initial[slots]
+
+        return predicted
 
-    def predict(self, x, y):
-        if self.initial_x is None:
-            self.initial_x = x
-            self.initial_y = y
 
-            return np.array([x, y])
-
-        self.kalman_filter.correct(np.array([x - self.initial_x, y - self.initial_y], dtype=np.float32))
-        predicted = self.kalman_filter.predict()
-        predicted_x = int(predicted[0][0]) + self.initial_x
-        predicted_y = int(predicted[1][0]) + self.initial_y
-
-        return np.array([predicted_x, predicted_y])
+class Track:
+    """Points of one track stored as growable arrays (struct of arrays).
+    centroids, boxes, indices, interpolated and has_box are views of the first len(track) points,
+    rows of boxes where has_box is False are missing boxes."""
 
+    __slots__ = ("object_id", "color", "label", "missed_boxes", "size",
+                 "_centroids", "_boxes", "_has_box", "_indices", "_interpolated")
 
-class Track:
-    def __init__(self, object_id, color, label=None):
+    def __init__(self, object_id, color, label=None, capacity=64):
         self.object_id = object_id
         self.color = color
         self.label = label
-        self.centroids = []
-        self.boxes = []
-        self.indices = []
-        self.interpolated = []
-        self.index2centroid = {}
-        self.index2box = {}
         self.missed_boxes = 0
+        self.size = 0
+        self._centroids = np.zeros((capacity, 2), dtype=np.int32)
+        self._boxes = np.zeros((capacity, 4), dtype=np.int32)
+        self._has_box = np.zeros(capacity, dtype=bool)
+        self._indices = np.zeros(capacity, dtype=np.int64)
+        self._interpolated = np.zeros(capacity, dtype=bool)
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def centroids(self):
+        return self._centroids[:self.size]
+
+    @property
+    def boxes(self):
+        return self._boxes[:self.size]
+
+    @property
+    def has_box(self):
+        return self._has_box[:self.size]
+
+    @property
+    def indices(self):
+        return self._indices[:self.size]
+
+    @property
+    def interpolated(self):
+        return self._interpolated[:self.size]
+
+    def append(self, index, centroid, box=None, interpolated=False):
+        if self.size == len(self._indices):
+            self.reserve(2 * max(1, self.size))
+
+        self._centroids[self.size] = centroid
+        self._indices[self.size] = index
+        self._interpolated[self.size] = interpolated
+
+        if box is None:
+            self._has_box[self.size] = False
+        else:
+            self._boxes[self.size] = box
+            self._has_box[self.size] = True
+
+        self.size += 1
+
+    def reserve(self, capacity):
+        if capacity <= len(self._indices):
+            return
+
+        for name in ("_centroids", "_boxes", "_has_box", "_indices", "_interpolated"):
+            current = getattr(self, name)
+            grown = np.zeros((capacity,) + current.shape[1:], dtype=current.dtype)
+            grown[:self.size] = current[:self.size]
+            setattr(self, name, grown)
+
+    def truncate(self, size):
+        self.size = max(0, min(self.size, size))
+
+    def interpolate(self):
+        """Fill all missing boxes between two boxes in one pass, the same values Tracks.update
+        computes per gap with np.linspace. Missing boxes before the first and after the last box stay missing."""
+
+        known = np.flatnonzero(self.has_box)
+
+        if len(known) < 2:
+            return
+
+        lengths = np.diff(known) - 1
+        gaps = lengths > 0
+
+        if not gaps.any():
+            return
+
+        lengths = lengths[gaps]
+        past = np.repeat(known[:-1][gaps], lengths)
+        current = np.repeat(known[1:][gaps], lengths)
+        rows = past + 1 + np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        divisor = (np.repeat(lengths, lengths) + 1)[:, None].astype(np.float64)
+        # Points are spaced from the current box back to the past one, as in np.linspace(current, past).
+        steps = (current - rows)[:, None].astype(np.float64)
+        start = self._boxes[current].astype(np.float64)
+        delta = self._boxes[past].astype(np.float64) - start
+        # np.linspace divides first when a coordinate does not change.
+        constant = (delta == 0).any(axis=1, keepdims=True)
+        values = np.where(constant, steps / divisor * delta, steps * (delta / divisor)) + start
+        self._boxes[rows] = np.floor(values)
+        self._has_box[rows] = True
+        self._interpolated[rows] = True
+
+    def position(self, index):
+        """Position of frame index in the track arrays or -1."""
+
+        position = np.searchsorted(self.indices, index)
+
+        if position < self.size and self._indices[position] == index:
+            return int(position)
+
+        return -1
+
+    def centroid_at(self, index):
+        position = self.position(index)
+
+        return None if position < 0 else self._centroids[position]
+
+    def box_at(self, index):
+        position = self.position(index)
+
+        return None if position < 0 or not self._has_box[position] else self._boxes[position]
+
+    def box_list(self, start=0):
+        """Boxes from start on as lists with None for missing boxes."""
+
+        return [box if has_box else None for box, has_box in zip(self.boxes[start:].tolist(),
+                                                                 self.has_box[start:].tolist())]
+
+    def to_dict(self, start=0):
+        """Points from start on, extend appends them to the first start points of a track."""
+
+        return {"object_id": self.object_id,
+                "color": list(self.color),
+                "label": self.label,
+                "centroids": self.centroids[start:].tolist(),
+                "boxes": self.box_list(start),
+                "indices": self.indices[start:].tolist(),
+                "interpolated": self.interpolated[start:].tolist(),
+                "missed_boxes": self.missed_boxes}
+
+    def extend(self, value):
+        """Append the points of a to_dict value."""
+
+        for centroid, box, index, interpolated in zip(value["centroids"], value["boxes"], value["indices"],
+                                                      value["interpolated"]):
+            self.append(index, centroid, box, interpolated)
+
+        self.missed_boxes = value.get("missed_boxes", 0)
+
+    @staticmethod
+    def from_arrays(object_id, color, label, indices, centroids, boxes, interpolated, has_box=None):
+        track = Track(object_id, color, label, capacity=max(1, len(indices)))
+        track.size = len(indices)
+        track._indices[:track.size] = indices
+        track._centroids[:track.size] = centroids
+        track._boxes[:track.size] = boxes
+        track._interpolated[:track.size] = interpolated
+        track._has_box[:track.size] = True if has_box is None else has_box
+
+        return track
+
+    @staticmethod
+    def from_dict(value):
+        track = Track(value["object_id"], value["color"], value["label"], capacity=max(1, len(value["indices"])))
+        track.extend(value)
+
+        return track
 
 
 class Tracks:
     def __init__(self, max_disappeared, interpolation=True,
-                 video_name=None, video_size=None, video_width=None, video_height=None):
+                 video_name=None, video_size=None, video_width=None, video_height=None, min_length=None):
         self.max_disappeared = max_disappeared
+        # Expired tracks not longer than min_length points are removed, 2 * max_disappeared by default.
+        self.min_length = max_disappeared * 2 if min_length is None else min_length
+        # True fills gaps as soon as the next box arrives, "deferred" once the track is refined or saved.
         self.interpolation = interpolation
         self.video_name = video_name
         self.video_size = video_size
         self.video_width = video_width
         self.video_height = video_height
+        # All tracks in memory, active tracks that can still expire and ids of finalized (refined) tracks.
         self.tracks = {}
-        self.refined = []
+        self.active = {}
+        self.refined = set()
+        # Ids finalized since the last flush.
+        self.finalized = []
+        # Min-heap of (last seen index, object id) with one entry per active track.
+        self.expiry = []
+        # Append-only file finalized tracks are streamed to and the state file of its checkpoint, see stream.
+        self.sidecar = None
+        self.sidecar_name = None
+        self.state_name = None
+        # Object id -> number of points of a live track in the sidecar file that do not change anymore.
+        self.checkpointed = {}
 
     def __getitem__(self, key):
         return self.tracks[key]
@@ -188,11 +516,16 @@ class Tracks:
     def __setitem__(self, key, value):
         if isinstance(value, Track):
             self.tracks[key] = value
+
+            if key not in self.refined:
+                self.activate(value)
         else:
             raise ValueError(f"Type {type(value)} is not supported.")
 
     def __delitem__(self, key):
         del self.tracks[key]
+        self.active.pop(key, None)
+        self.refined.discard(key)
 
     def keys(self):
         return self.tracks.keys()
@@ -205,71 +538,220 @@ class Tracks:
 
     def update(self, objects, index):
         for object in objects:
-            if self.tracks.get(object.object_id) is None:
-                if object.label is None:
-                    self.tracks[object.object_id] = Track(object.object_id, object.color)
-                else:
-                    self.tracks[object.object_id] = Track(object.object_id, object.color, object.label)
+            track = self.tracks.get(object.object_id)
+
+            if track is None:
+                track = Track(object.object_id, object.color, object.label)
+                track.append(index, object.centroid, object.box)
+                self.tracks[object.object_id] = track
+                self.refined.discard(object.object_id)
+                self.activate(track)
+            else:
+                track.append(index, object.centroid, object.box)
+
+            if self.interpolation and self.interpolation != "deferred":
+                if object.box is None:
+                    track.missed_boxes += 1
+                elif track.missed_boxes > 0:
+                    current = track.size - 1
+                    past = current - track.missed_boxes - 1
+
+                    if past >= 0:
+                        interpolated_boxes = np.linspace(track._boxes[current], track._boxes[past],
+                                                         track.missed_boxes + 2, dtype=np.int32)[1:-1]
+                        track._boxes[past + 1:current] = interpolated_boxes[::-1]
+                        track._has_box[past + 1:current] = True
+                        track._interpolated[past + 1:current] = True
+
+                    track.missed_boxes = 0
+
+        # Only tracks not seen for more than max_disappeared frames are visited.
+        while len(self.expiry) > 0 and index - self.expiry[0][0] > self.max_disappeared:
+            last, object_id = heapq.heappop(self.expiry)
+            track = self.active.get(object_id)
+
+            if track is None:
+                # Track was deleted or finalized through another entry.
+                continue
+
+            if track.indices[-1] != last:
+                # Seen again since the entry was pushed.
+                heapq.heappush(self.expiry, (int(track.indices[-1]), object_id))
+                continue
 
-            self.tracks[object.object_id].centroids.append(object.centroid)
-            self.tracks[object.object_id].index2centroid[index] = object.centroid
+            del self.active[object_id]
 
-            if object.box is None:
-                self.tracks[object.object_id].boxes.append(None)
-                self.tracks[object.object_id].index2box[index] = None
+            if len(track) > self.min_length:
+                # Refine track.
+                track.truncate(len(track) - self.max_disappeared)
+
+                if self.interpolation == "deferred":
+                    track.interpolate()
+
+                self.refined.add(object_id)
+                self.finalized.append(object_id)
             else:
-                self.tracks[object.object_id].boxes.append(object.box)
-                self.tracks[object.object_id].index2box[index] = object.box
-
-            self.tracks[object.object_id].indices.append(index)
-            self.tracks[object.object_id].interpolated.append(False)
-
-            if self.interpolation:
-                if self.tracks[object.object_id].boxes[-1] is None:
-                    self.tracks[object.object_id].missed_boxes += 1
-                elif self.tracks[object.object_id].missed_boxes > 0:
-                    current_box = self.tracks[object.object_id].boxes[-1]
-                    past_box = self.tracks[object.object_id].boxes[-self.tracks[object.object_id].missed_boxes - 2]
-
-                    coordinates_0 = np.linspace(current_box[0], past_box[0],
-                                                self.tracks[object.object_id].missed_boxes + 2, dtype=np.int32)[1:-1]
-                    coordinates_1 = np.linspace(current_box[1], past_box[1],
-                                                self.tracks[object.object_id].missed_boxes + 2, dtype=np.int32)[1:-1]
-                    coordinates_2 = np.linspace(current_box[2], past_box[2],
-                                                self.tracks[object.object_id].missed_boxes + 2, dtype=np.int32)[1:-1]
-                    coordinates_3 = np.linspace(current_box[3], past_box[3],
-                                                self.tracks[object.object_id].missed_boxes + 2, dtype=np.int32)[1:-1]
-                    interpolated_boxes = np.vstack((coordinates_0, coordinates_1, coordinates_2, coordinates_3)).T
-
-                    for i, box in enumerate(interpolated_boxes):
-                        box = list(box)
-                        current = len(self.tracks[object.object_id].boxes) - 2 - i
-                        self.tracks[object.object_id].boxes[current] = box
-                        self.tracks[object.object_id].index2box[current] = box
-                        self.tracks[object.object_id].interpolated[current] = True
-
-                    self.tracks[object.object_id].missed_boxes = 0
-
-        for object_id in list(self.tracks.keys()):
-            if object_id in self.refined:
-                continue
+                # Auto-remove track.
+                del self.tracks[object_id]
 
-            last = self.tracks[object_id].indices[-1]
+        if self.sidecar is not None and len(self.finalized) > 0:
+            for track in self.flush():
+                self.sidecar.write(json.dumps({"track": track.to_dict()}) + "\n")
 
-            if index - last > self.max_disappeared:
-                if len(self.tracks[object_id].indices) > self.max_disappeared * 2:
-                    # Refine track.
-                    self.tracks[object_id].centroids = self.tracks[object_id].centroids[:-self.max_disappeared]
-                    self.tracks[object_id].boxes = self.tracks[object_id].boxes[:-self.max_disappeared]
-                    self.tracks[object_id].indices = self.tracks[object_id].indices[:-self.max_disappeared]
-                    self.refined.append(object_id)
-                else:
-                    # Auto-remove track.
-                    del self.tracks[object_id]
+            self.sidecar.flush()
+
+    def interpolate(self):
+        """Fill gaps of the tracks in memory, with interpolation="deferred" update only does it on refine."""
+
+        if self.interpolation == "deferred":
+            for track in self.tracks.values():
+                track.interpolate()
+
+    def activate(self, track):
+        self.active[track.object_id] = track
+        heapq.heappush(self.expiry, (int(track.indices[-1]) if len(track) > 0 else -1, track.object_id))
+
+    def flush(self):
+        """Remove finalized tracks from memory and return them. They are not changed by later updates."""
+
+        flushed = [self.tracks.pop(object_id) for object_id in self.finalized if object_id in self.tracks]
+        self.finalized = []
+
+        return flushed
+
+    def stream(self, filename, resume=False):
+        """Write finalized tracks to a JSON lines sidecar file as soon as they are refined,
+        so memory is bounded by live tracks and an interrupted run keeps its finished tracks.
+        checkpoint appends the new points of live tracks and saves the rest in {filename}.state.json.
+        resume restores the tracks of an existing file up to its last checkpoint and returns
+        (checkpoint, state passed to checkpoint), processing continues from checkpoint + 1.
+        Without a checkpoint it returns (-1, None) and the file starts over."""
+
+        checkpoint, state = -1, None
+        self.state_name = f"{filename}.state.json"
+
+        if resume and os.path.exists(filename):
+            saved = None
+
+            if os.path.exists(self.state_name):
+                with open(self.state_name, "r") as file:
+                    saved = json.load(file)
+
+                if saved["offset"] > os.path.getsize(filename):
+                    # State of another run of the sidecar file.
+                    saved = None
+
+            if saved is not None:
+                checkpoint, state = saved["checkpoint"], saved["state"]
+
+            # Tracks written after the checkpoint are produced again from its live tracks.
+            with open(filename, "r+b") as file:
+                file.truncate(0 if saved is None else saved["offset"])
+
+            points = {}
+
+            with open(filename, "r") as file:
+                for line in file:
+                    entry = json.loads(line)
+
+                    if "track" in entry:
+                        self.refined.add(entry["track"]["object_id"])
+                    else:
+                        value = entry["points"]
+                        track = points.get(value["object_id"])
+
+                        if track is None:
+                            points[value["object_id"]] = Track.from_dict(value)
+                        else:
+                            track.truncate(value["start"])
+                            track.extend(value)
+
+            if saved is not None:
+                for object_id, size, missed_boxes in saved["tracks"]:
+                    track = points[object_id]
+                    track.truncate(size)
+                    track.missed_boxes = missed_boxes
+                    self[object_id] = track
+                    self.checkpointed[object_id] = size - missed_boxes
+        elif os.path.exists(self.state_name):
+            os.remove(self.state_name)
+
+        self.sidecar_name = filename
+        self.sidecar = open(filename, "a" if resume else "w")
+
+        return checkpoint, state
+
+    def checkpoint(self, index, state=None):
+        """Save live tracks and the caller's JSON serializable state (e.g. Tracker.get_state) after frame index,
+        so stream(resume=True) continues without losing points. Only points added since the last checkpoint
+        are appended to the sidecar file, the state file is replaced atomically."""
+
+        for track in self.flush():
+            self.sidecar.write(json.dumps({"track": track.to_dict()}) + "\n")
+
+        checkpointed = {}
+
+        for track in self.tracks.values():
+            start = self.checkpointed.get(track.object_id, 0)
+
+            if len(track) > start:
+                self.sidecar.write(json.dumps({"points": dict(track.to_dict(start), start=start)}) + "\n")
+
+            # Boxes of the trailing points without a box are still filled by update, they are written again.
+            checkpointed[track.object_id] = len(track) - track.missed_boxes
+
+        self.checkpointed = checkpointed
+        self.sidecar.flush()
+        saved = {"checkpoint": index, "offset": self.sidecar.tell(), "state": state,
+                 "tracks": [[track.object_id, len(track), track.missed_boxes] for track in self.tracks.values()]}
+
+        with open(f"{self.state_name}.tmp", "w") as file:
+            json.dump(saved, file)
+
+        os.replace(f"{self.state_name}.tmp", self.state_name)
+
+    def streamed(self):
+        """Tracks written to the sidecar file."""
+
+        if self.sidecar is None:
+            return
+
+        self.sidecar.flush()
+
+        with open(self.sidecar_name, "r") as file:
+            for line in file:
+                entry = json.loads(line)
+
+                if "track" in entry:
+                    yield Track.from_dict(entry["track"])
+
+    def all_tracks(self):
+        """Streamed tracks followed by tracks in memory."""
+
+        yield from self.streamed()
+        yield from self.tracks.values()
+
+    def close(self, remove=False):
+        if self.sidecar is not None:
+            self.sidecar.close()
+
+            if remove:
+                os.remove(self.sidecar_name)
+
+                if os.path.exists(self.state_name):
+                    os.remove(self.state_name)
+
+        self.sidecar = None
+        self.sidecar_name = None
+        self.state_name = None
 
     def reset(self):
         self.tracks = {}
-        self.refined = []
+        self.active = {}
+        self.refined = set()
+        self.finalized = []
+        self.expiry = []
+        self.checkpointed = {}
 
     def load(self, filename, format):
         if format == "json":
@@ -282,104 +764,126 @@ class Tracks:
                 self.max_disappeared = data["max_disappeared"]
 
             if data.get("interpolation") is not None:
-                self.video_name = data["interpolation"]
+                self.interpolation = data["interpolation"]
 
             if data.get("video_name") is not None:
                 self.video_name = data["video_name"]
 
             if data.get("video_size") is not None:
-                self.video_name = data["video_size"]
+                self.video_size = data["video_size"]
 
             if data.get("video_width") is not None:
-                self.video_name = data["video_width"]
+                self.video_width = data["video_width"]
 
             if data.get("video_height") is not None:
-                self.video_name = data["video_height"]
+                self.video_height = data["video_height"]
+
+            if data.get("refined") is not None:
+                self.refined = set(data["refined"])
 
             if data.get("tracks") is not None:
                 for value in data["tracks"].values():
-                    object_id = value["object_id"]
-                    color = value["color"]
-                    label = value["label"]
-                    centroids = []
-
-                    for centroid in value["centroids"]:
-                        centroids.append(np.array(centroid))
-
-                    track = Track(object_id, color, label)
-                    track.centroids = centroids
-                    track.boxes = value["boxes"]
-                    track.indices = value["indices"]
-                    track.interpolated = value["interpolated"]
-                    track.index2centroid = value["index2centroid"]
-                    track.index2box = value["index2box"]
-                    track.missed_boxes = value["missed_boxes"]
-                    self.tracks[object_id] = track
-
-            if data.get("refined") is not None:
-                self.refined = data["refined"]
+                    track = Track.from_dict(value)
+                    self[track.object_id] = track
+        elif format == "npz":
+            self.reset()
+            # Points of all tracks are memory-mapped, track i owns rows offsets[i]:offsets[i + 1].
+            data = load_npz(filename, mmap_mode="c")
+            meta = data["meta"].tolist()
+            self.max_disappeared, self.video_size, self.video_width, self.video_height = [
+                None if value < 0 else value for value in meta]
+            self.interpolation = {"True": True, "False": False}.get(data["interpolation"].item(), "deferred")
+            self.video_name = data["video_name"].item() if data["has_video_name"].item() else None
+            self.refined = set(data["refined"].tolist())
+            labels = data["labels"].tolist()
+            offsets = data["offsets"].tolist()
+
+            for i, (object_id, color, label, missed_boxes) in enumerate(
+                    zip(data["object_ids"].tolist(), data["colors"].tolist(), data["track_labels"].tolist(),
+                        data["missed_boxes"].tolist())):
+                rows = slice(offsets[i], offsets[i + 1])
+                track = Track(object_id, color, None if label < 0 else labels[label], capacity=0)
+                # Views of the mapped file, copied on write and reallocated by the first append.
+                track._indices = data["indices"][rows]
+                track._centroids = data["centroids"][rows]
+                track._boxes = data["boxes"][rows]
+                track._has_box = data["has_box"][rows]
+                track._interpolated = data["interpolated"][rows]
+                track.size = offsets[i + 1] - offsets[i]
+                track.missed_boxes = missed_boxes
+                self[object_id] = track
         elif format == "cvat":
             self.reset()
-            root = etree.parse(filename).getroot()
-
-            if root.find("meta").find("task").find("source") is not None:
-                self.video_name = "".join(root.find("meta").find("task").find("source").itertext())
-
-            if root.find("meta").find("task").find("size") is not None:
-                self.video_size = int("".join(root.find("meta").find("task").find("size").itertext()))
-
-            if root.find("meta").find("task").find("original_size").find("width") is not None:
-                self.video_width = int(
-                    "".join(root.find("meta").find("task").find("original_size").find("width").itertext()))
-
-            if root.find("meta").find("task").find("original_size").find("height") is not None:
-                self.video_width = int(
-                    "".join(root.find("meta").find("task").find("original_size").find("height").itertext()))
-
-            for xml_track in root.iterfind("track"):
-                object_id = int(xml_track.attrib["id"])
-                label = xml_track.attrib["label"]
-
+            annotation = Annotation.load(filename)
+            self.video_name = annotation.source
+            self.video_size = annotation.size
+            self.video_width = annotation.width
+            self.video_height = annotation.height
+            boxes = annotation.boxes().astype(np.int64)
+            centroids = (boxes[:, :2] + (boxes[:, 2:] - boxes[:, :2]) / 2).astype(np.int64)
+            colors_values = list(Tracker.colors_table.values())
+
+            for object_id, label, rows, _ in annotation.tracks():
                 if label == "None":
                     label = None
 
-                colors_values = list(Tracker.colors_table.values())
                 color = colors_values[object_id % len(colors_values)]
-                track = Track(object_id, color, label)
-
-                for box in xml_track.iter("box"):
-                    index = int(box.attrib["frame"])
-                    interpolated = not bool(int(box.attrib["keyframe"]))
-                    x_start = int(float(box.attrib["xtl"]))
-                    y_start = int(float(box.attrib["ytl"]))
-                    x_end = int(float(box.attrib["xbr"]))
-                    y_end = int(float(box.attrib["ybr"]))
-                    x_center = int(x_start + (x_end - x_start) / 2)
-                    y_center = int(y_start + (y_end - y_start) / 2)
-                    box = [x_start, y_start, x_end, y_end]
-                    centroid = np.array([x_center, y_center])
-                    track.centroids.append(centroid)
-                    track.boxes.append(box)
-                    track.indices.append(index)
-                    track.interpolated.append(interpolated)
-                    track.index2centroid[index] = centroid
-                    track.index2box[index] = box
-
-                self.tracks[object_id] = track
-                self.refined.append(object_id)
+                self.tracks[object_id] = Track.from_arrays(object_id, color, label, annotation.frame[rows],
+                                                           centroids[rows], boxes[rows], ~annotation.keyframe[rows])
+                self.refined.add(object_id)
         else:
             raise ValueError(f"Format {format} is not supported.")
 
     def save(self, filename, format):
+        self.interpolate()
+
         if format == "json":
+            data = {"max_disappeared": self.max_disappeared,
+                    "interpolation": self.interpolation,
+                    "video_name": self.video_name,
+                    "video_size": self.video_size,
+                    "video_width": self.video_width,
+                    "video_height": self.video_height,
+                    "tracks": {track.object_id: track.to_dict() for track in self.all_tracks()},
+                    "refined": sorted(self.refined)}
+
             with open(filename, "w") as file:
-                json.dump(self, file, default=lambda object: object.tolist() if isinstance(object, (
-                    np.ndarray, np.generic)) else object.__dict__)
+                json.dump(data, file)
+        elif format == "npz":
+            tracks = list(self.all_tracks())
+            label2index = {}
+
+            for track in tracks:
+                if track.label is not None:
+                    label2index.setdefault(track.label, len(label2index))
+
+            meta = [-1 if value is None else value
+                    for value in (self.max_disappeared, self.video_size, self.video_width, self.video_height)]
+
+            def column(name, shape, dtype):
+                if len(tracks) == 0:
+                    return np.zeros((0,) + shape, dtype=dtype)
+
+                return np.concatenate([getattr(track, name) for track in tracks]).astype(dtype, copy=False)
+
+            # Uncompressed, so load can memory-map every array.
+            np.savez(filename, meta=np.array(meta, dtype=np.int64), interpolation=np.array(str(self.interpolation)),
+                     video_name=np.array(self.video_name or ""), has_video_name=np.array(self.video_name is not None),
+                     refined=np.array(sorted(self.refined), dtype=np.int64),
+                     labels=np.array(list(label2index.keys()), dtype=str),
+                     object_ids=np.array([track.object_id for track in tracks], dtype=np.int64),
+                     colors=np.array([list(track.color) for track in tracks], dtype=np.int32).reshape(-1, 3),
+                     track_labels=np.array([label2index.get(track.label, -1) for track in tracks], dtype=np.int32),
+                     missed_boxes=np.array([track.missed_boxes for track in tracks], dtype=np.int64),
+                     offsets=np.cumsum([0] + [len(track) for track in tracks], dtype=np.int64),
+                     indices=column("indices", (), np.int64), centroids=column("centroids", (2,), np.int32),
+                     boxes=column("boxes", (4,), np.int32), has_box=column("has_box", (), bool),
+                     interpolated=column("interpolated", (), bool))
         elif format == "cvat":
-            # Create CVAT for video 1.1 XML.
-            xml_page = etree.Element("annotations")
-            etree.SubElement(xml_page, "version").text = "1.1"
-            xml_meta = etree.SubElement(xml_page, "meta")
+            # Stream CVAT for video 1.1 XML track by track, .gz filenames are compressed.
+            xml_version = etree.Element("version")
+            xml_version.text = "1.1"
+            xml_meta = etree.Element("meta")
             xml_task = etree.SubElement(xml_meta, "task")
 
             if self.video_size is not None:
@@ -396,31 +900,57 @@ class Tracks:
             if self.video_name is not None:
                 etree.SubElement(xml_task, "source").text = f"{self.video_name}"
 
-            for track in self.tracks.values():
-                xml_track = etree.Element("track", id=str(track.object_id), label=str(track.label), source="manual")
-
-                for box_id, (box, frame_id, interpolated) in enumerate(
-                        zip(track.boxes, track.indices, track.interpolated)):
-                    # Mark the end of the track.
-                    if box_id == len(track.boxes) - 1:
-                        outside = "1"
-                    else:
-                        outside = "0"
+            # Same layout as pretty printing the whole document.
+            etree.indent(xml_meta, space="  ", level=1)
 
-                    if box is None:
-                        continue
+            with (gzip.open if filename.endswith(".gz") else open)(filename, "wb") as file:
+                file.write(b"<?xml version='1.0' encoding='UTF-8'?>\n")
 
-                    xml_box = etree.Element("box", frame=str(frame_id), outside=outside, occluded="0",
-                                            keyframe=str(int(not interpolated)), xtl=f"{box[0]:.2f}",
-                                            ytl=f"{box[1]:.2f}",
-                                            xbr=f"{box[2]:.2f}", ybr=f"{box[3]:.2f}", z_order="0")
+                with etree.xmlfile(file, encoding="utf-8") as xml_file:
+                    with xml_file.element("annotations"):
+                        xml_file.write("\n  ")
+                        xml_file.write(xml_version)
+                        xml_file.write("\n  ")
+                        xml_file.write(xml_meta)
 
-                    xml_track.append(xml_box)
+                        for track in self.all_tracks():
+                            if len(track) > 0:
+                                xml_file.write("\n  ")
+                                self.write_cvat_track(xml_file, track)
 
-                if len(track.boxes) > 0:
-                    xml_page.append(xml_track)
+                        xml_file.write("\n")
 
-            xml_document = etree.ElementTree(xml_page)
-            xml_document.write(filename, xml_declaration=True, pretty_print=True, encoding="utf-8")
+                file.write(b"\n")
         else:
             raise ValueError(f"Format {format} is not supported.")
+
+    @staticmethod
+    def write_cvat_track(xml_file, track):
+        attributes = {"id": str(track.object_id), "label": str(track.label), "source": "manual"}
+
+        if not track.has_box.any():
+            xml_file.write(etree.Element("track", attributes))
+            return
+
+        last = len(track) - 1
+
+        with xml_file.element("track", attributes):
+            for box_id, (box, frame_id, interpolated, has_box) in enumerate(
+                    zip(track.boxes.tolist(), track.indices.tolist(), track.interpolated.tolist(),
+                        track.has_box.tolist())):
+                if not has_box:
+                    continue
+
+                # Mark the end of the track.
+                if box_id == last:
+                    outside = "1"
+                else:
+                    outside = "0"
+
+                xml_file.write("\n    ")
+                xml_file.write(etree.Element("box", frame=str(frame_id), outside=outside, occluded="0",
+                                             keyframe=str(int(not interpolated)), xtl=f"{box[0]:.2f}",
+                                             ytl=f"{box[1]:.2f}", xbr=f"{box[2]:.2f}", ybr=f"{box[3]:.2f}",
+                                             z_order="0"))
+
+            xml_file.write("\n  ")
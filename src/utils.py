@@ -1,43 +1,107 @@
+import struct
+import zipfile
 import numpy as np
 import cv2
 
 
-def get_scene(image, object, scene_width, scene_height):
+def load_npz(filename, mmap_mode="r"):
+    """Arrays of an .npz file as a dict, members stored without compression (np.savez)
+    are memory-mapped instead of read, compressed members are read as usual."""
+
+    arrays = {}
+
+    with zipfile.ZipFile(filename) as archive, open(filename, "rb") as file:
+        for info in archive.infolist():
+            key = info.filename[:-len(".npy")] if info.filename.endswith(".npy") else info.filename
+
+            if info.compress_type != zipfile.ZIP_STORED:
+                with archive.open(info) as member:
+                    arrays[key] = np.lib.format.read_array(member)
+
+                continue
+
+            # The member data follows the 30 byte local file header, its name and extra field.
+            file.seek(info.header_offset)
+            header = file.read(30)
+            name_length, extra_length = struct.unpack("<HH", header[26:30])
+            file.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(file)
+
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file)
+
+            if dtype.hasobject or np.prod(shape) == 0:
+                file.seek(info.header_offset + 30 + name_length + extra_length)
+                arrays[key] = np.lib.format.read_array(file, allow_pickle=False)
+            else:
+                arrays[key] = np.memmap(filename, dtype=dtype, mode=mmap_mode, offset=file.tell(), shape=shape,
+                                        order="F" if fortran_order else "C")
+
+    return arrays
+
+
+def get_scene_windows(centroids, boxes, has_box, image_width, image_height, scene_width, scene_height):
+    """Source windows of the mini-scenes of all objects at once: scene sized windows around the centroid,
+    or wider windows around boxes taller than the scene, padded with black where they leave the frame.
+    Returns (N, 4) x_start, y_start, x_end, y_end crops inside the frame and (N, 4) top, bottom, left, right padding."""
+
+    centroids = np.asarray(centroids, dtype=np.int64).reshape(-1, 2)
+    boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
     width = scene_width // 2
     height = scene_height // 2
-    pad_top = 0
-    pad_bottom = 0
-    pad_left = 0
-    pad_right = 0
-    size = object.box[3] - object.box[1]
-
-    if object.box is not None and size > scene_height:
-        coefficient = size / scene_height
-        margin = 50
-        start_x = np.max([0, object.centroid[0] - int(width * coefficient) - margin])
-        start_y = np.max([0, object.box[1] - margin])
-        end_x = np.min([image.shape[1] - 1, object.centroid[0] + int(width * coefficient) + margin])
-        end_y = np.min([image.shape[0] - 1, object.box[3] + margin])
-    else:
-        start_x = np.max([0, object.centroid[0] - width])
-        start_y = np.max([0, object.centroid[1] - height])
-        end_x = np.min([image.shape[1] - 1, object.centroid[0] + width])
-        end_y = np.min([image.shape[0] - 1, object.centroid[1] + height])
-
-    crop = image[start_y:end_y, start_x:end_x]
-
-    if object.centroid[0] - width < 0:
-        pad_left = width - object.centroid[0]
-
-    if object.centroid[1] - height < 0:
-        pad_top = height - object.centroid[1]
-
-    if object.centroid[0] + width > image.shape[1] - 1:
-        pad_right = object.centroid[0] + width - image.shape[1] + 1
-
-    if object.centroid[1] + height > image.shape[0] - 1:
-        pad_bottom = object.centroid[1] + height - image.shape[0] + 1
-
-    padded = cv2.copyMakeBorder(crop, pad_top, pad_bottom, pad_left, pad_right, cv2.BORDER_CONSTANT, value=(0, 0, 0))
-
-    return cv2.resize(padded, (scene_width, scene_height), interpolation=cv2.INTER_AREA)
+    margin = 50
+    x, y = centroids[:, 0], centroids[:, 1]
+    size = boxes[:, 3] - boxes[:, 1]
+    large = np.asarray(has_box, dtype=bool) & (size > scene_height)
+    reach = (width * (size / scene_height)).astype(np.int64) + margin
+    start_x = np.where(large, np.maximum(0, x - reach), np.maximum(0, x - width))
+    start_y = np.where(large, np.maximum(0, boxes[:, 1] - margin), np.maximum(0, y - height))
+    end_x = np.where(large, np.minimum(image_width - 1, x + reach), np.minimum(image_width - 1, x + width))
+    end_y = np.where(large, np.minimum(image_height - 1, boxes[:, 3] + margin),
+                     np.minimum(image_height - 1, y + height))
+    pad_left = np.maximum(0, width - x)
+    pad_top = np.maximum(0, height - y)
+    pad_right = np.maximum(0, x + width - image_width + 1)
+    pad_bottom = np.maximum(0, y + height - image_height + 1)
+    crops = np.stack((start_x, start_y, np.maximum(end_x, start_x), np.maximum(end_y, start_y)), axis=1)
+
+    return crops, np.stack((pad_top, pad_bottom, pad_left, pad_right), axis=1)
+
+
+def get_scenes(image, objects, scene_width, scene_height):
+    """Mini-scenes of all objects of a frame. Windows are computed in one step, scenes that need no scaling
+    are cropped and padded by a single cv2.warpAffine reading the frame in place. Larger windows are padded
+    and shrunk with INTER_AREA from a slice of the frame, so the frame itself is never copied."""
+
+    if len(objects) == 0:
+        return []
+
+    crops, pads = get_scene_windows([object.centroid for object in objects],
+                                    [[0, 0, 0, 0] if object.box is None else object.box for object in objects],
+                                    [object.box is not None for object in objects],
+                                    image.shape[1], image.shape[0], scene_width, scene_height)
+    # The last row and column of the frame are never part of a scene, pixels outside the view become black.
+    view = image[:image.shape[0] - 1, :image.shape[1] - 1]
+    scenes = []
+
+    for (start_x, start_y, end_x, end_y), (top, bottom, left, right) in zip(crops.tolist(), pads.tolist()):
+        width, height = end_x - start_x + left + right, end_y - start_y + top + bottom
+
+        if width == scene_width and height == scene_height:
+            matrix = np.array([[1, 0, start_x - left], [0, 1, start_y - top]], dtype=np.float64)
+            scenes.append(cv2.warpAffine(view, matrix, (scene_width, scene_height),
+                                         flags=cv2.INTER_NEAREST | cv2.WARP_INVERSE_MAP,
+                                         borderMode=cv2.BORDER_CONSTANT, borderValue=(0, 0, 0)))
+        else:
+            padded = cv2.copyMakeBorder(image[start_y:end_y, start_x:end_x], top, bottom, left, right,
+                                        cv2.BORDER_CONSTANT, value=(0, 0, 0))
+            scenes.append(cv2.resize(padded, (scene_width, scene_height), interpolation=cv2.INTER_AREA))
+
+    return scenes
+
+
+def get_scene(image, object, scene_width, scene_height):
+    return get_scenes(image, [object], scene_width, scene_height)[0]
+
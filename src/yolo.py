@@ -1,39 +1,261 @@
 import numpy as np
 from ultralytics import YOLO
+from src.detections import Detections
 
 
 class YOLOv8:
-    def __init__(self, weights="yolov8x.pt", imgsz=640, conf=0.5):
+    # COCO classes kept by the detector and the labels they are saved with.
+    name2label = {"zebra": "Zebra", "horse": "Zebra", "giraffe": "Giraffe"}
+
+    def __init__(self, weights="yolov8x.pt", imgsz=640, conf=0.5, tile_size=None, tile_overlap=0.2):
+        """tile_size enables sliced inference: frames are cut into overlapping tiles of tile_size pixels,
+        tiles are detected in one batch and merged back with cross-tile NMS.
+        tile_overlap is the fraction of the tile shared with its neighbours."""
+
         self.conf = conf
         self.imgsz = imgsz
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
         self.model = YOLO(weights)
         self.names = self.model.names
+        self.labels = list(dict.fromkeys(YOLOv8.name2label.values()))
+        self.classes = [key for key, value in self.names.items() if value in YOLOv8.name2label]
+        # Lookup table from model class id to index in self.labels, -1 for ignored classes.
+        self.class2label = np.full(max(self.names.keys()) + 1, -1, dtype=np.int32)
+
+        for key in self.classes:
+            self.class2label[key] = self.labels.index(YOLOv8.name2label[self.names[key]])
 
     def forward(self, image):
-        width = image.shape[1]
-        height = image.shape[0]
-        boxes = self.model.predict(source=image[:, :, ::-1].astype(np.uint8),
-                                   imgsz=self.imgsz, iou=0.5, nms=True, agnostic_nms=True, verbose=False)[0].boxes.cpu()
-        filtered = []
-
-        for box, label, confidence in zip(boxes.xyxyn.numpy(), boxes.cls.numpy(), boxes.conf.numpy()):
-            if confidence > self.conf:
-                if self.names[label] in ["zebra", "horse", "giraffe"]:
-                    box[0] = int(box[0] * width)
-                    box[1] = int(box[1] * height)
-                    box[2] = int(box[2] * width)
-                    box[3] = int(box[3] * height)
-                    box = box.astype(np.int32)
-                    confidence = float(f"{confidence:.2f}")
-
-                    if self.names[label] == "horse":
-                        label = "Zebra"
-                    else:
-                        label = self.names[label].capitalize()
-
-                    filtered.append(([box[0], box[1], box[2], box[3]], confidence, label))
-
-        return filtered
+        return self.detect(image).to_list()
+
+    def forward_batch(self, images):
+        """Run detection on a list of frames in one model call.
+        Returns a list with filtered detections for every frame."""
+
+        return [detections.to_list() for detections in self.detect_batch(images)]
+
+    def detect(self, image):
+        return self.detect_batch([image])[0]
+
+    def detect_batch(self, images):
+        """Same as forward_batch, but returns Detections arrays instead of tuple lists."""
+
+        if len(images) == 0:
+            return []
+
+        if self.tile_size is not None:
+            return self.detect_tiled(images)
+
+        results = self.predict([image[:, :, ::-1].astype(np.uint8) for image in images], self.imgsz)
+
+        return [self.filter(result.boxes.cpu(), image.shape[1], image.shape[0])
+                for result, image in zip(results, images)]
+
+    def detect_tiled(self, images):
+        """Cut every frame into overlapping tiles, detect all tiles in one batch,
+        map boxes back to frame coordinates and merge duplicates across tiles."""
+
+        regions = [self.get_tiles(image.shape[1], image.shape[0], self.tile_size, self.tile_overlap)
+                   for image in images]
+
+        return self.detect_regions(images, regions, self.tile_size)
+
+    def detect_regions(self, images, regions, imgsz):
+        """Detect (x_start, y_start, x_end, y_end) regions of every frame in one batch,
+        map boxes back to frame coordinates and merge duplicates across overlapping regions."""
+
+        crops = []
+        owners = []
+
+        for i, (image, image_regions) in enumerate(zip(images, regions)):
+            for k, (x_start, y_start, x_end, y_end) in enumerate(image_regions):
+                crops.append(image[y_start:y_end, x_start:x_end, ::-1].astype(np.uint8))
+                owners.append((i, k, x_start, y_start))
+
+        results = self.predict(crops, imgsz) if len(crops) > 0 else []
+        detections = [[] for _ in images]
+        origins = [[] for _ in images]
+
+        for result, crop, (i, k, x_start, y_start) in zip(results, crops, owners):
+            entry = self.filter(result.boxes.cpu(), crop.shape[1], crop.shape[0], offset=(x_start, y_start))
+            detections[i].append(entry)
+            origins[i].append(np.full(len(entry), k, dtype=np.int64))
+
+        return [self.merge(Detections.concatenate(entries, self.labels),
+                           np.concatenate(image_origins) if len(image_origins) > 0 else np.zeros(0, dtype=np.int64),
+                           image_regions, image.shape[1], image.shape[0])
+                for entries, image_origins, image_regions, image in zip(detections, origins, regions, images)]
+
+    def predict(self, images, imgsz):
+        # Only the wanted classes go through NMS.
+        return self.model.predict(source=images, imgsz=imgsz, iou=0.5, nms=True, agnostic_nms=True,
+                                  classes=self.classes, verbose=False)
+
+    def filter(self, boxes, width, height, offset=(0, 0)):
+        """Filter and rescale all boxes of one image at once."""
+
+        xyxyn = boxes.xyxyn.numpy()
+        class_ids = self.class2label[boxes.cls.numpy().astype(np.int64)]
+        scores = boxes.conf.numpy()
+        mask = (scores > self.conf) & (class_ids >= 0)
+        scale = np.array([width, height, width, height], dtype=np.float32)
+        shift = np.array([offset[0], offset[1], offset[0], offset[1]], dtype=np.int32)
+        scaled = (xyxyn[mask] * scale).astype(np.int32) + shift
+
+        return Detections(scaled, scores[mask], class_ids[mask], self.labels)
+
+    @staticmethod
+    def merge(detections, origins, regions, width, height, threshold=0.5, margin=2):
+        """Drop detections duplicated by neighbouring regions. origins are the indices of the regions
+        the detections come from, boxes of the same region were already deduplicated by the model.
+        A box within margin pixels of a region border inside the frame is cut by it: the parts of an animal
+        cut by the shared border of two regions are joined, other cut boxes lose against complete boxes."""
+
+        if len(detections) < 2:
+            return detections
+
+        regions = np.asarray(regions, dtype=np.int64).reshape(-1, 4)
+        members = np.zeros((len(detections), len(regions)), dtype=bool)
+        members[np.arange(len(detections)), origins] = True
+        boxes, scores, class_ids, members, bounds = YOLOv8.join(detections.boxes.astype(np.int64), detections.scores,
+                                                                detections.class_ids, members, regions[origins],
+                                                                (width, height), threshold, margin)
+        cut = YOLOv8.get_cut(boxes, bounds, (width, height), margin).any(axis=1)
+        keep = YOLOv8.nms(boxes.astype(np.float32), scores, members, cut, threshold)
+
+        return Detections(boxes[keep], scores[keep], class_ids[keep], detections.labels)
+
+    @staticmethod
+    def get_cut(boxes, bounds, size, margin):
+        """(N, 4) mask of the borders (left, top, right, bottom) of their regions boxes are cut by,
+        borders of the frame do not cut."""
+
+        near = (boxes[:, :2] <= bounds[:, :2] + margin) & (bounds[:, :2] > 0)
+        far = (boxes[:, 2:] >= bounds[:, 2:] - margin) & (bounds[:, 2:] < np.asarray(size))
+
+        return np.concatenate((near, far), axis=1)
+
+    @staticmethod
+    def join(boxes, scores, class_ids, members, bounds, size, threshold, margin):
+        """Replace pairs of boxes cut by the shared border of two neighbouring regions with their union,
+        first along x, then along y, so an animal spanning four tiles becomes one box. The parts must
+        overlap inside the shared strip and on the other axis by more than threshold of the shorter one.
+        members are (N, regions) masks of the regions boxes come from, joined boxes come from the regions
+        of both parts and get their bounds."""
+
+        boxes, scores, class_ids, members, bounds = boxes.copy(), scores.copy(), class_ids.copy(), \
+            members.copy(), bounds.copy()
+        alive = np.ones(len(boxes), dtype=bool)
+
+        for axis in (0, 1):
+            other = 1 - axis
+
+            while True:
+                cut = YOLOv8.get_cut(boxes, bounds, size, margin) & alive[:, None]
+                # First part cut by the far border of its region, second part by the near border of a region
+                # starting inside the first region.
+                pairs = cut[:, None, 2 + axis] & cut[None, :, axis] & \
+                        (bounds[None, :, axis] > bounds[:, None, axis]) & \
+                        (bounds[None, :, axis] < bounds[:, None, 2 + axis]) & \
+                        (boxes[:, None, axis] < boxes[None, :, axis]) & \
+                        (boxes[:, None, 2 + axis] < boxes[None, :, 2 + axis])
+                overlap = np.minimum(boxes[:, None, 2 + other], boxes[None, :, 2 + other]) - \
+                    np.maximum(boxes[:, None, other], boxes[None, :, other])
+                extent = boxes[:, 2 + other] - boxes[:, other]
+                shorter = np.maximum(np.minimum(extent[:, None], extent[None, :]), 1)
+                ratio = np.where(pairs, overlap / shorter, 0)
+                first, second = np.nonzero(ratio > threshold)
+
+                if len(first) == 0:
+                    break
+
+                used = np.zeros(len(boxes), dtype=bool)
+
+                for i, j in sorted(zip(first.tolist(), second.tolist()), key=lambda pair: -ratio[pair]):
+                    if used[i] or used[j]:
+                        continue
+
+                    used[i] = used[j] = True
+                    boxes[i, :2] = np.minimum(boxes[i, :2], boxes[j, :2])
+                    boxes[i, 2:] = np.maximum(boxes[i, 2:], boxes[j, 2:])
+                    bounds[i, :2] = np.minimum(bounds[i, :2], bounds[j, :2])
+                    bounds[i, 2:] = np.maximum(bounds[i, 2:], bounds[j, 2:])
+
+                    if scores[j] > scores[i]:
+                        scores[i], class_ids[i] = scores[j], class_ids[j]
+
+                    members[i] |= members[j]
+                    alive[j] = False
+
+        return boxes[alive], scores[alive], class_ids[alive], members[alive], bounds[alive]
+
+    @staticmethod
+    def nms(boxes, scores, members, cut, threshold=0.5):
+        """Class-agnostic NMS over intersection of the smaller box between boxes without a common region
+        (members are (N, regions) masks), so an animal cut by a region border is suppressed by its complete box
+        from the next region.
+        Complete boxes win over cut ones, then larger boxes over smaller ones, then higher scores.
+        Returns indices of kept boxes sorted by score."""
+
+        areas = np.maximum(0, boxes[:, 2] - boxes[:, 0]) * np.maximum(0, boxes[:, 3] - boxes[:, 1])
+        order = np.lexsort((-scores, -areas, cut))
+        keep = []
+
+        while len(order) > 0:
+            i = order[0]
+            keep.append(i)
+            rest = order[1:]
+            width = np.maximum(0, np.minimum(boxes[i, 2], boxes[rest, 2]) - np.maximum(boxes[i, 0], boxes[rest, 0]))
+            height = np.maximum(0, np.minimum(boxes[i, 3], boxes[rest, 3]) - np.maximum(boxes[i, 1], boxes[rest, 1]))
+            smaller = np.maximum(np.minimum(areas[i], areas[rest]), 1)
+            order = rest[(width * height / smaller <= threshold) | (members[rest] & members[i]).any(axis=1)]
+
+        keep = np.array(keep, dtype=np.int64)
+
+        return keep[np.argsort(-scores[keep], kind="stable")]
+
+    @staticmethod
+    def get_tiles(width, height, tile_size, overlap):
+        """Return (x_start, y_start, x_end, y_end) of overlapping tiles covering the frame."""
+
+        step = max(1, int(tile_size * (1 - overlap)))
+
+        def starts(size):
+            if size <= tile_size:
+                return [0]
+
+            positions = list(range(0, size - tile_size, step))
+            positions.append(size - tile_size)
+
+            return positions
+
+        return [(x, y, min(x + tile_size, width), min(y + tile_size, height))
+                for y in starts(height) for x in starts(width)]
+
+    @staticmethod
+    def get_regions(boxes, width, height, size, padding):
+        """Return (x_start, y_start, x_end, y_end) windows of at least size pixels covering every box
+        grown by padding, a box already inside a window does not get its own."""
+
+        regions = []
+
+        for x_start, y_start, x_end, y_end in sorted(np.asarray(boxes).reshape(-1, 4).tolist()):
+            x_start, y_start = max(0, x_start - padding), max(0, y_start - padding)
+            x_end, y_end = min(width, x_end + padding), min(height, y_end + padding)
+
+            if any(x_start >= region[0] and y_start >= region[1] and x_end <= region[2] and y_end <= region[3]
+                   for region in regions):
+                continue
+
+            region_width = min(width, max(size, x_end - x_start))
+            region_height = min(height, max(size, y_end - y_start))
+            # Center the window on the box and keep it inside the frame.
+            left = min(max(0, (x_start + x_end - region_width) // 2), width - region_width)
+            top = min(max(0, (y_start + y_end - region_height) // 2), height - region_height)
+            regions.append((left, top, left + region_width, top + region_height))
+
+        return regions
 
     @staticmethod
     def get_centroid(box):
@@ -1,16 +1,22 @@
 import numpy as np
 import os
-import sys
 import json
-from lxml import etree
+import argparse
 import shutil
+import traceback
+import multiprocessing
+import queue
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 import cv2
-from src.utils import get_scene
+from src.utils import get_scenes
+from src.cvat import Annotation
 from collections import OrderedDict
 from src.detector import Detector
 from src.tracker import Tracker, Tracks
 from src.object import Object
 from src.draw import Draw
+from src.encoder import EncoderPool
+from src.frames import FrameReader
 from tqdm import tqdm
 
 
@@ -46,28 +52,69 @@ def generate_timeline_image(name, folder, timeline, annotated_size):
     cv2.imwrite(f"mini-scenes/{folder}/metadata/{name}.jpg", timeline_resized)
 
 
-def extract(video_path, annotation_path, tracking):
-    # Parse CVAT for video 1.1 annotation file.
-    root = etree.parse(annotation_path).getroot()
-    annotated = dict()
+class QueueProgress:
+    """Stand-in for tqdm in worker processes, sends (total, done) increments to the parent through queue."""
+
+    def __init__(self, queue, total, chunk=50):
+        self.queue = queue
+        self.chunk = chunk
+        self.done = 0
+        self.queue.put((total, 0))
+
+    def update(self, n):
+        self.done += n
+
+        if self.done >= self.chunk:
+            self.queue.put((0, self.done))
+            self.done = 0
+
+    def close(self):
+        if self.done > 0:
+            self.queue.put((0, self.done))
+            self.done = 0
+
+
+def get_metadata_path(video_path):
+    name = os.path.splitext(video_path.split("/")[-1])[0]
+    folder = os.path.splitext("|".join(video_path.split("/")[-3:]))[0]
+
+    return f"mini-scenes/{folder}/metadata/{name}_metadata.json"
+
+
+def is_extracted(video_path):
+    """True when the metadata of video_path, written last by extract, exists and is complete."""
+
+    try:
+        with open(get_metadata_path(video_path), "r") as file:
+            timeline = json.load(file)
+    except (OSError, ValueError):
+        return False
 
-    for track in root.iterfind("track"):
-        track_id = int(track.attrib["id"])
+    return isinstance(timeline, dict) and all(key in timeline for key in ("original", "tracks", "colors")) \
+        and "main" in timeline["tracks"]
 
-        for box in track.iter("box"):
-            frame_id = int(box.attrib["frame"])
 
-            if annotated.get(frame_id) is None:
-                annotated[frame_id] = OrderedDict()
+def extract(video_path, annotation_path, tracking, headless=False, demo_scale=1.0, encoders=2, max_writers=64,
+            progress=None):
+    """headless skips the preview window, demo_scale sets the resolution of the overview video
+    (0 disables it, player.py needs it for the drone view).
+    Mini-scenes are encoded by encoders background threads with at most max_writers open videos.
+    progress is a queue receiving (total, done) frame counts instead of the progress bar."""
 
-            annotated[frame_id][track_id] = [int(float(box.attrib["xtl"])),
-                                             int(float(box.attrib["ytl"])),
-                                             int(float(box.attrib["xbr"])),
-                                             int(float(box.attrib["ybr"]))]
+    # Parse CVAT for video 1.1 annotation file.
+    annotation = Annotation.load(annotation_path)
+    annotated = dict()
+
+    for frame_id, track_id, box in zip(annotation.frame.tolist(), annotation.track_id.tolist(),
+                                       annotation.boxes().astype(np.int64).tolist()):
+        if annotated.get(frame_id) is None:
+            annotated[frame_id] = OrderedDict()
+
+        annotated[frame_id][track_id] = box
 
     name = os.path.splitext(video_path.split("/")[-1])[0]
     folder = os.path.splitext("|".join(video_path.split("/")[-3:]))[0]
-    annotated_size = int("".join(root.find("meta").find("task").find("size").itertext()))
+    annotated_size = annotation.size
     scene_width, scene_height = 400, 300
     vc = cv2.VideoCapture(video_path)
     original_width, original_height = int(vc.get(cv2.CAP_PROP_FRAME_WIDTH)), int(vc.get(cv2.CAP_PROP_FRAME_HEIGHT))
@@ -77,89 +124,108 @@ def extract(video_path, annotation_path, tracking):
     if not os.path.exists(f"mini-scenes/{folder}"):
         os.makedirs(f"mini-scenes/{folder}")
 
-    vw = cv2.VideoWriter(f"mini-scenes/{folder}/{name}.mp4", cv2.VideoWriter_fourcc("m", "p", "4", "v"), 29.97,
-                         (original_width, original_height))
+    demo_size = (int(original_width * demo_scale), int(original_height * demo_scale))
+
+    if demo_scale > 0:
+        vw = cv2.VideoWriter(f"mini-scenes/{folder}/{name}.mp4", cv2.VideoWriter_fourcc("m", "p", "4", "v"), 29.97,
+                             demo_size)
+    else:
+        vw = None
+
+    # Frames are only drawn on when somebody is going to look at them.
+    visualize = not headless or vw is not None
+
     max_disappeared = 40
     tracker = Tracker(max_disappeared=max_disappeared, max_distance=300)
-    tracks = Tracks(max_disappeared=max_disappeared, interpolation=True)
-    index = 0
+    tracks = Tracks(max_disappeared=max_disappeared, interpolation="deferred")
     tracked_indices = OrderedDict()
     timeline = OrderedDict()
     timeline["original"] = video_path
     timeline["tracks"] = OrderedDict()
     timeline["tracks"]["main"] = [-1] * annotated_size
     timeline["colors"] = {}
-    vc.set(cv2.CAP_PROP_POS_FRAMES, index)
-    tracks_vw = dict()
-    pbar = tqdm(total=annotated_size)
+    tracks_vw = EncoderPool(f"mini-scenes/{folder}", (scene_width, scene_height), 29.97, encoders, max_writers)
+    pbar = tqdm(total=annotated_size) if progress is None else QueueProgress(progress, annotated_size)
 
-    while vc.isOpened():
-        returned, frame = vc.read()
+    # Without preview and overview video only annotated frames are decoded.
+    skip = headless and vw is None
+    reader = FrameReader(vc, FrameReader.annotated(annotation) if skip else None)
+    decoded = 0
 
-        if returned:
+    for index, frame in reader:
+        if visualize:
             visualization = frame.copy()
 
-            if annotated.get(index) is not None:
-                centroids = []
-                attributes = []
-                objects = OrderedDict()
-                colors = OrderedDict()
-
-                for object_id, box in annotated[index].items():
-                    attribute = {}
-                    centroid = Detector.get_centroid(box)
-                    centroids.append(centroid)
-                    attribute["box"] = box
-                    attributes.append(attribute)
-
-                    if not tracking:
-                        objects[object_id] = centroid
-                        colors_values = list(tracker.colors_table.values())
-                        colors[object_id] = colors_values[object_id % len(colors_values)]
-                        timeline["colors"][object_id] = colors[object_id]
-
-                if tracking:
-                    objects, colors = tracker.update(centroids)
-
-                objects = Object.object_factory(objects, centroids, colors, attributes=attributes)
-                tracks.update(objects, index)
-
-                for object in objects:
-                    if tracks_vw.get(object.object_id) is None:
-                        if not os.path.exists(f"mini-scenes/{folder}"):
-                            os.makedirs(f"mini-scenes/{folder}")
-
-                        tracks_vw[object.object_id] = cv2.VideoWriter(f"mini-scenes/{folder}/{object.object_id}.mp4",
-                                                                      cv2.VideoWriter_fourcc("m", "p", "4", "v"),
-                                                                      29.97, (scene_width, scene_height))
-                        tracked_indices[object.object_id] = 0
-                        timeline["tracks"][object.object_id] = [-1] * annotated_size
-
-                for object in objects:
+        if annotated.get(index) is not None:
+            centroids = []
+            predictions = []
+            objects = OrderedDict()
+            colors = OrderedDict()
+            assignment = OrderedDict()
+
+            for object_id, box in annotated[index].items():
+                centroid = Detector.get_centroid(box)
+                centroids.append(centroid)
+                predictions.append((box, None, None))
+
+                if not tracking:
+                    objects[object_id] = centroid
+                    assignment[object_id] = len(predictions) - 1
+                    colors_values = list(tracker.colors_table.values())
+                    colors[object_id] = colors_values[object_id % len(colors_values)]
+                    timeline["colors"][object_id] = colors[object_id]
+
+            if tracking:
+                objects, colors, assignment = tracker.update(centroids, return_assignment=True)
+
+            objects = Object.from_assignment(objects, colors, assignment, predictions)
+            tracks.update(objects, index)
+
+            for object in objects:
+                if tracked_indices.get(object.object_id) is None:
+                    tracked_indices[object.object_id] = 0
+                    timeline["tracks"][object.object_id] = [-1] * annotated_size
+
+            # Mini-scenes are cut from the untouched frame, drawings only go to the visualization.
+            scenes = get_scenes(frame, objects, scene_width, scene_height)
+
+            for object, scene in zip(objects, scenes):
+                if visualize:
                     Draw.track(visualization, tracks[object.object_id].centroids, object.color, 20)
                     Draw.scene(visualization, object, scene_width, scene_height)
                     Draw.object_id(visualization, object)
-                    scene_frame = frame.copy()
-                    scene_frame = get_scene(scene_frame, object, scene_width, scene_height)
-                    tracks_vw[object.object_id].write(scene_frame)
-                    timeline["tracks"][object.object_id][index] = tracked_indices[object.object_id]
-                    tracked_indices[object.object_id] += 1
 
+                tracks_vw.write(object.object_id, scene)
+                timeline["tracks"][object.object_id][index] = tracked_indices[object.object_id]
+                tracked_indices[object.object_id] += 1
+
+        key = -1
+
+        if not headless:
             cv2.imshow("tracks_extractor", cv2.resize(visualization,
                                                       (int(original_width // 2.5), int(original_height // 2.5))))
-            vw.write(visualization)
             key = cv2.waitKey(1)
-            timeline["tracks"]["main"][index] = index
-            index += 1
-            pbar.update(1)
 
-            if key == 27:
-                break
-        else:
+        if vw is not None:
+            if demo_scale == 1:
+                vw.write(visualization)
+            else:
+                vw.write(cv2.resize(visualization, demo_size, interpolation=cv2.INTER_AREA))
+
+        timeline["tracks"]["main"][index] = index
+        pbar.update(index + 1 - decoded)
+        decoded = index + 1
+
+        if key == 27:
             break
 
-    for track_key in tracks_vw.keys():
-        tracks_vw[track_key].release()
+    if skip:
+        # Same timeline as decoding every frame.
+        last = min(int(vc.get(cv2.CAP_PROP_FRAME_COUNT)), annotated_size)
+        timeline["tracks"]["main"][:last] = list(range(last))
+        pbar.update(max(0, last - decoded))
+
+    tracks_vw.close()
 
     if not os.path.exists(f"mini-scenes/{folder}/actions"):
         os.makedirs(f"mini-scenes/{folder}/actions")
@@ -170,29 +236,113 @@ def extract(video_path, annotation_path, tracking):
     shutil.copy(annotation_path, f"mini-scenes/{folder}/metadata/{name}_tracks.xml")
     generate_timeline_image(name, folder, timeline, annotated_size)
 
-    with open(f"mini-scenes/{folder}/metadata/{name}_metadata.json", "w") as file:
+    # Written last and atomically, a complete metadata file marks a finished video.
+    metadata_path = get_metadata_path(video_path)
+
+    with open(f"{metadata_path}.tmp", "w") as file:
         json.dump(timeline, file)
 
+    os.replace(f"{metadata_path}.tmp", metadata_path)
+
     pbar.close()
     vc.release()
-    vw.release()
-    cv2.destroyAllWindows()
 
+    if vw is not None:
+        vw.release()
 
-if __name__ == "__main__":
-    if len(sys.argv) != 3 and len(sys.argv) != 4:
-        print("python tracks_extractor.py path_to_videos path_to_annotations [tracking]")
-        exit(0)
-    elif len(sys.argv) == 3:
-        video = sys.argv[1]
-        annotation = sys.argv[2]
-        tracking = False
+    if not headless:
+        cv2.destroyAllWindows()
+
+
+def extract_worker(*args):
+    """extract in a worker process, returns the traceback of a failure as text (not every exception pickles)."""
+
+    try:
+        extract(*args)
+    except Exception:
+        return traceback.format_exc()
+
+    return None
+
+
+def extract_all(videos, annotations, tracking, demo_scale, encoders, max_writers, workers):
+    """Extract pairs in workers processes with one aggregated progress bar.
+    A failing video is reported and does not stop the others, returns the failed videos."""
+
+    failed = []
+
+    with multiprocessing.Manager() as manager, ProcessPoolExecutor(workers) as executor:
+        progress = manager.Queue()
+        futures = {executor.submit(extract_worker, video, annotation, tracking, True, demo_scale, encoders, max_writers,
+                                   progress): video for video, annotation in zip(videos, annotations)}
+        pending = set(futures)
+        pbar = tqdm(total=0)
+
+        def drain():
+            while True:
+                try:
+                    total, done = progress.get_nowait()
+                except queue.Empty:
+                    return
+
+                if total > 0:
+                    pbar.total += total
+                    pbar.refresh()
+
+                pbar.update(done)
+
+        while len(pending) > 0:
+            finished, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+            drain()
+
+            for future in finished:
+                try:
+                    error = future.result()
+                except Exception:
+                    error = traceback.format_exc()
+
+                if error is not None:
+                    failed.append(futures[future])
+                    tqdm.write(f"{futures[future]} failed:\n{error}")
+
+        drain()
+        pbar.close()
+
+    return failed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Extract mini-scenes from CVAT tracks.")
+    parser.add_argument("path_to_videos", help="video file or folder with videos")
+    parser.add_argument("path_to_annotations", help="CVAT for video 1.1 file or folder with annotations")
     # tracking=True: use external tracker instead of CVAT tracks.
     # tracking=False: use CVAT tracks.
-    elif len(sys.argv) == 4:
-        video = sys.argv[1]
-        annotation = sys.argv[2]
-        tracking = bool(sys.argv[3])
+    parser.add_argument("tracking", nargs="?", default="", help="use external tracker instead of CVAT tracks")
+    parser.add_argument("--headless", action="store_true",
+                        help="do not show the preview window")
+    parser.add_argument("--demo-scale", type=float, default=1.0,
+                        help="resolution scale of the overview video, 0 disables it")
+    parser.add_argument("--encoders", type=int, default=2,
+                        help="number of background threads encoding mini-scenes")
+    parser.add_argument("--max-writers", type=int, default=64,
+                        help="maximum number of mini-scene videos open at once, idle ones continue in segments")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of videos of a folder extracted in parallel processes (implies --headless)")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip videos whose metadata is already complete")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    video = args.path_to_videos
+    annotation = args.path_to_annotations
+    tracking = bool(args.tracking)
+    headless = args.headless
+    demo_scale = args.demo_scale
+    encoders = args.encoders
+    max_writers = args.max_writers
 
     if os.path.isdir(annotation):
         videos = []
@@ -209,13 +359,26 @@ if __name__ == "__main__":
                     videos.append(os.path.join(video + root[len(annotation):], os.path.splitext(file)[0] + ".mp4"))
                     annotations.append(os.path.join(root, file))
 
-        for i, (video, annotation) in enumerate(zip(videos, annotations)):
-            print(f"{i + 1}/{len(annotations)}:")
+        pairs = []
 
+        for i, (video, annotation) in enumerate(zip(videos, annotations)):
             if not os.path.exists(video):
-                print(f"Path {video} does not exist.")
-                continue
-
-            extract(video, annotation, tracking)
+                print(f"{i + 1}/{len(annotations)}: Path {video} does not exist.")
+            elif args.resume and is_extracted(video):
+                print(f"{i + 1}/{len(annotations)}: {video} already done")
+            elif args.workers > 1:
+                pairs.append((video, annotation))
+            else:
+                print(f"{i + 1}/{len(annotations)}:")
+                extract(video, annotation, tracking, headless, demo_scale, encoders, max_writers)
+
+        if len(pairs) > 0:
+            failed = extract_all(*zip(*pairs), tracking, demo_scale, encoders, max_writers, args.workers)
+            print(f"{len(pairs) - len(failed)}/{len(pairs)} videos extracted.")
+
+            for video in failed:
+                print(f"Failed: {video}")
+    elif args.resume and is_extracted(video):
+        print(f"{video} already done")
     else:
-        extract(video, annotation, tracking)
+        extract(video, annotation, tracking, headless, demo_scale, encoders, max_writers)
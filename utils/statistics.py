@@ -1,9 +1,11 @@
 import os
 import sys
-from lxml import etree
 import matplotlib.pyplot as plt
 import seaborn as sns
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from src.cvat import Annotation
+
 if __name__ == "__main__":
     if len(sys.argv) != 2:
         print("python statistics.py path_to_mini_scenes")
@@ -64,19 +66,13 @@ if __name__ == "__main__":
             actions_xml = f"{path_to_mini_scenes}/{folder}/actions/{file}"
 
             if os.path.splitext(file)[1] == ".xml":
-                root = etree.parse(actions_xml).getroot()
-
-                for track in root.iterfind("track"):
-                    label = track.attrib["label"]
-
-                    for entry in track.iter("points"):
-                        outside = entry.attrib["outside"]
-
-                        if outside == "1":
-                            continue
+                annotation = Annotation.load(actions_xml)
+                # Points without a behavior attribute have behavior -1 and are not counted.
+                counted = ~annotation.point_outside & (annotation.behavior >= 0)
 
-                        behavior = "".join(entry.find("attribute").itertext())
-                        data[label][behavior] += 1
+                for label, behavior in zip(annotation.point_label[counted].tolist(),
+                                           annotation.behavior[counted].tolist()):
+                    data[annotation.labels[label]][annotation.behaviors[behavior]] += 1
 
     sns.set(font_scale=1.2)
     plt.figure(figsize=(17, 17))